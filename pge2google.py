@@ -26,6 +26,7 @@
 # 1) Download the Python API files from
 # http://code.google.com/p/google-powermeter-api-client/downloads/list
 # This script must be run from the same directory as google_meter.py
+# (except with --debug or --output, which never contact Google)
 #
 # 2) Follow the instructions at
 # http://code.google.com/apis/powermeter/docs/powermeter_device_activation.html
@@ -37,6 +38,20 @@
 #
 # 2b) (Optional) Set up a config file in ~/.local/pge2google/config
 #                If you do, you don't need to provide --token and --variable
+#                Its [main] section is the default profile; every other
+#                section is a profile picked with --profile <section>:
+#
+#                [main]
+#                token: TOKEN
+#                variable: VAR
+#
+#                [cabin]
+#                token: TOKEN2
+#                variable: VAR2
+#                timezone: Mountain
+#                rate: 50
+#                burst: 500
+#                files: ~/pge/cabin/*.csv
 #
 # 3) Download your data files from PG&E. Matt Colyer has a ruby script for this
 #    at http://github.com/mcolyer/smartermeter
@@ -46,22 +61,22 @@
 #
 # Features: Directly uploads to Google PowerMeter. 
 #           Handles Daylight Savings transitions correctly as of 2010. 
+#           Reads gzip, bzip2 and xz compressed files and zip archives
+#           without extracting them.
+#           Exports readings to CSV, JSON lines or a binary file (--output).
 #               
 #
 # Bugs / Assumptions:
 #
-# A1) Assumes times given are all in Pacific time. Which is how the
-# files I've downloaded from PG&E are specified. Unfortunately the
-# header data does not specify the time zone, so we have to make this
-# assumption.
+# A1) Assumes times given are all in Pacific time, unless told otherwise
+# with --timezone or a profile's 'timezone'. Pacific is how the files
+# I've downloaded from PG&E are specified. Unfortunately the header data
+# does not specify the time zone, so we have to make this assumption.
 # 
-# A2) Expects only hourly data. If PG&E ever offers higher resolution,
-# two things must happen:
-#    1) in parseHeaders(), don't abort if the title isn't 'Hourly Usage'
-#    2) processDSTDay() has to be modified to handle whatever the new format is.
-#
-#    Basically, other than handling DST transitions everything should
-#    be ready to go as long as the time header is the same.
+# A2) Handles hourly and sub-hourly (e.g. 15-minute) data; the slot width
+# is taken from the time header. On the fall DST day, PG&E folds both
+# 1 AM hours into the 1 AM slots, so each of those slots is stretched to
+# cover twice its width.
 #
 # B2) I do a lot of Error/Warning/Info printfs, but I should probably use the
 # Log class. 
@@ -70,22 +85,51 @@
 import os
 import sys
 import csv
+import gzip
+import bz2
+import zipfile
+import bisect
+import calendar
+import glob
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import struct
+import tempfile
+import multiprocessing
+import sqlite3
+import threading
+import Queue
 import time as sleeptime
+from array import array
+from itertools import chain, izip
 from datetime import tzinfo, timedelta, datetime, date, time
 from optparse import OptionParser
-import google_meter
-import units
-import rfc3339
 import ConfigParser as cp
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
 
 programVersion = '0.9'
 programName = 'pge2google'
 config_filename = 'config'
 
 def parseArguments():
-  op = OptionParser('%prog [--token <token>] [--variable <variable>] Filename.csv [File2.csv [...]]\n\n' + '''
+  op = OptionParser('%prog [--token <token>] [--variable <variable>] Filename.csv [File2.csv [...]]\n'
+                    '       %prog --profile <name> [--profile <name> [...]] [Filename.csv [...]]\n'
+                    '       %prog [--token <token>] [--variable <variable>] --watch <dir>\n'
+                    '       %prog query [--help] Filename.csv [File2.csv [...]]\n\n' + '''
 arguments:
-  Filename.csv        The Hourly usage CSV datafile from PG&E (required)''', version="%s %s" % (programName, programVersion))
+  Filename.csv        The Hourly usage CSV datafile from PG&E (required,
+                      unless every selected meter lists its own files).
+                      May be compressed (.gz, .bz2, .xz) or a .zip of
+                      several CSV files.''', version="%s %s" % (programName, programVersion))
   op.add_option('', '--token', metavar='<token>',
                 help='Google PowerMeter OAUTH Token'
                      ' (default: None)')
@@ -96,7 +140,31 @@ arguments:
                 help='URI prefix of the GData service to contact '
                      '(default: https://www.google.com/powermeter/feeds)')
   op.add_option('-f','--configFile', metavar='<configFile>', help="Path and filename of configuration file (default: ~/.local/%s/config)" % programName)
-  op.add_option('-d','--debug', dest="isDebug", action="store_true", help="Disable upload to Google (default: false)", default=False)
+  op.add_option('-d','--debug', dest="isDebug", action="store_true", help="Parse and convert the input, but send it nowhere (default: false)", default=False)
+  op.add_option('-o','--output', metavar='<file>', help="Write the readings to <file> instead of uploading them; with several meters, each gets its own file (default: None)")
+  op.add_option('', '--format', metavar='<format>', type='choice', choices=sorted(SINK_FORMATS),
+                help="Format of the --output file: 'csv', 'jsonl' or 'binary' (default: from the file extension, binary if unknown)")
+  op.add_option('-s','--stream', dest="isStream", action="store_true", help="Upload readings while the files are still being parsed; each file must be in time order (default: false)", default=False)
+  op.add_option('-l','--ledger', metavar='<file>', help="SQLite file recording what was already uploaded, so it is not sent again (default: None)")
+  op.add_option('', '--rate', metavar='<N>', type='float', help="Average number of readings uploaded per minute (default: the profile's 'rate', or 100)")
+  op.add_option('', '--burst', metavar='<N>', type='int', help="Most readings uploaded at once, and the batch size (default: the profile's 'burst', or 1000)")
+  op.add_option('', '--timezone', metavar='<zone>', help="US time zone of the input files, e.g. Pacific or EST (default: the profile's 'timezone', or Pacific)")
+  op.add_option('-p','--profile', dest='meters', metavar='<name>', action='append', help="Upload to the meter of config file section [<name>]; may be repeated (default: None)", default=[])
+  op.add_option('-m','--meter', dest='meters', metavar='<name>', action='append', help="Same as --profile")
+  op.add_option('', '--all-meters', dest='allMeters', action='store_true', help="Upload to every profile of the config file but [main] (default: false)", default=False)
+  op.add_option('-w','--workers', metavar='<N>', type='int', help="Number of meters uploaded concurrently (default: 4)", default=4)
+  op.add_option('', '--stats', dest='isStats', action='store_true', help="Print per-stage timings and counters when done (default: false)", default=False)
+  op.add_option('', '--stats-file', dest='statsFile', metavar='<file>', help="Write per-stage timings and counters to <file>, as a Prometheus textfile if it ends in .prom and as JSON otherwise (default: None)")
+  op.add_option('-r','--rollup', metavar='<hours>', type='float', help="Merge contiguous readings into measurements of up to <hours> each, aligned on local midnight, before uploading (default: None)")
+  op.add_option('-c','--cache', metavar='<dir>', help="Directory caching the readings parsed from each input file (default: None)")
+  op.add_option('', '--cache-size', dest='cacheSize', metavar='<MB>', type='float', help="Size the cache directory is kept under (default: 256)", default=256.0)
+  op.add_option('', '--watch', metavar='<dir>', help="Keep running, uploading files as they appear or change in <dir>; use with --ledger, or a restart uploads them all again (default: None)")
+  op.add_option('', '--interval', metavar='<seconds>', type='float', help="How often --watch looks for new files (default: 60)", default=60.0)
+  op.add_option('', '--dedup', metavar='<policy>', type='choice', choices=DEDUP_POLICIES,
+                help="Which reading to keep when input files overlap: 'latest' (from the file given last), 'first', or 'nonzero' (the latest non-zero one) (default: latest)", default='latest')
+  op.add_option('', '--auto-batch', dest='isAutoBatch', action='store_true', help="Adapt the batch size (at most --burst) to how long flushes take and how often they fail (default: false)", default=False)
+  op.add_option('', '--flush-latency', dest='flushLatency', metavar='<seconds>', type='float', help="How long a flush should take with --auto-batch (default: 10)", default=10.0)
+  op.add_option('-j','--jobs', metavar='<N>', type='int', help="Number of processes used to parse the input files (default: 1)", default=1)
 
   op.set_defaults(service='https://www.google.com/powermeter/feeds',
                   unit='kW h', uncertainty=0.001, time_uncertainty=1)
@@ -121,44 +189,182 @@ arguments:
       else:
         sys.stderr.write("Error: Can not find config file '%s'\n" % options.configFile)
         exit(2)
-  
-  if options.token == None:
-    if checkConfigfile(options.configFile,'token'):
-      options.token = getConfigfile(options.configFile,'token')
-    else:
-      sys.stderr.write('Error: Missing Google Power Meter OAuth token. \nToken must be supplied via --token or in the config file.\n')
+
+  if options.output is not None and options.format is None:
+    extension = os.path.splitext(options.output)[1].lower()
+    options.format = SINK_EXTENSIONS.get(extension, 'binary')
+  # Only uploads need a token and variable.
+  isGoogle = options.output is None and not options.isDebug
+  config = None
+  if options.configFile is not None:
+    config = loadConfig(options.configFile)
+  if options.timezone is not None:
+    try:
+      options.timezone = lookupTimeZone(options.timezone)
+    except ValueError, e:
+      sys.stderr.write('Error: Bad --timezone (%s).\n' % e)
+      op.exit(2, op.format_help())
+
+  if options.watch is not None and (options.meters or options.allMeters):
+    sys.stderr.write('Error: --watch can not be combined with --profile or --all-meters.\n')
+    op.exit(2, op.format_help())
+  if options.meters or options.allMeters:
+    if config is None:
+      sys.stderr.write('Error: --profile and --all-meters need a config file.\n')
       op.exit(2, op.format_help())
-  if options.variable == None:
-    if checkConfigfile(options.configFile,'variable'):
-      options.variable = getConfigfile(options.configFile,'variable')
+    options.targets = config.targets(options.meters, args, isGoogle)
+    if len(options.targets) == 0:
+      sys.stderr.write('Error: The config file has no meter sections.\n')
+      op.exit(2, op.format_help())
+    for target in options.targets:
+      if len(target.filenames) < 1:
+        sys.stderr.write("Error: No input file specified for meter '%s'.\n" % target.name)
+        op.exit(2, op.format_help())
+  else:
+    if config is not None and config.parser.has_section('main'):
+      target = config.target('main', args, False)
     else:
-      sys.stderr.write('Error: Missing Google Power Meter variable.\nVariable must be supplied via --variable or in the config file.\n')
-      op.exit(2,op.format_help())
+      target = Target('main', None, None, args)
+    if len(args) > 0:
+      target.filenames = args
+    if options.token is not None:
+      target.token = options.token
+    if options.variable is not None:
+      target.variable = options.variable
+    if isGoogle:
+      if target.token == None:
+        sys.stderr.write('Error: Missing Google Power Meter OAuth token. \nToken must be supplied via --token or in the config file.\n')
+        op.exit(2, op.format_help())
+      if target.variable == None:
+        sys.stderr.write('Error: Missing Google Power Meter variable.\nVariable must be supplied via --variable or in the config file.\n')
+        op.exit(2,op.format_help())
 
-  if len(args) < 1:
-    sys.stderr.write('Error: No input file specified.\n')
+    if options.watch is not None:
+      if not os.path.isdir(options.watch):
+        sys.stderr.write("Error: Can not find directory '%s'\n" % options.watch)
+        op.exit(2, op.format_help())
+    elif len(target.filenames) < 1:
+      sys.stderr.write('Error: No input file specified.\n')
+      op.exit(2, op.format_help())
+    options.targets = [target]
+
+  for target in options.targets:
+    if options.timezone is not None:
+      target.tz = options.timezone
+    if options.rate is not None:
+      target.rate = options.rate
+    if options.burst is not None:
+      target.burst = options.burst
+    if target.rate <= 0 or target.burst < 1:
+      sys.stderr.write("Error: The rate and burst of '%s' must be positive.\n" % target.name)
+      op.exit(2, op.format_help())
+  if options.rollup is not None and int(options.rollup * 3600) <= 0:
+    sys.stderr.write('Error: --rollup must be positive.\n')
+    op.exit(2, op.format_help())
+  if options.flushLatency <= 0:
+    sys.stderr.write('Error: --flush-latency must be positive.\n')
+    op.exit(2, op.format_help())
+  if options.interval <= 0:
+    sys.stderr.write('Error: --interval must be positive.\n')
+    op.exit(2, op.format_help())
+  if options.jobs < 1 or options.workers < 1:
+    sys.stderr.write('Error: --jobs and --workers must be at least 1.\n')
     op.exit(2, op.format_help())
 
   return (args, options)
 
-def checkConfigfile(filename,var):
-  with open(filename) as f:
-    parser = cp.SafeConfigParser()
+class Config:
+  """A config file, parsed once. Each section is a profile: [main] is the
+  one used by default, the others are meters selected with --profile.
+  A profile may set 'token', 'variable', 'timezone', 'rate', 'burst' and
+  'files'.
+  Members:
+  filename (str)\tPath of the config file
+  parser (SafeConfigParser)\tIts parsed content"""
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.parser = cp.SafeConfigParser()
+    with open(filename) as f:
+      try:
+        self.parser.readfp(f)
+      except cp.MissingSectionHeaderError:
+        sys.stderr.write("Error: Config file seems to be invalid (Missing Section 'main')\n")
+        exit(1)
+
+  def get(self, profile, var, default=None):
+    """Returns var of profile, or default if it is not set."""
+    if self.parser.has_option(profile, var):
+      return self.parser.get(profile, var)
+    return default
+
+  def profiles(self):
+    """Names of the meter profiles, i.e. of every section but [main]."""
+    return [section for section in self.parser.sections() if section != 'main']
+
+  def target(self, name, filenames, isGoogle=True):
+    """Returns the Target of profile name. It needs 'token' and 'variable'
+    if isGoogle, and may list its input files as whitespace-separated glob
+    patterns in 'files'; otherwise filenames are used."""
+    if not self.parser.has_section(name):
+      sys.stderr.write("Error: Config file has no section '%s'\n" % name)
+      exit(2)
+    if isGoogle:
+      for var in ('token', 'variable'):
+        if not self.parser.has_option(name, var):
+          sys.stderr.write("Error: Config file section '%s' is missing '%s'\n" % (name, var))
+          exit(2)
+    files = self.get(name, 'files')
+    if files is not None:
+      filenames = list()
+      for pattern in files.split():
+        filenames.extend(sorted(glob.glob(os.path.expanduser(pattern))))
+    target = Target(name, self.get(name, 'token'), self.get(name, 'variable'), filenames)
     try:
-      parser.readfp(f)
-      hasVar = parser.has_option('main',var)
-      return hasVar
-    except cp.MissingSectionHeaderError:
-      sys.stderr.write("Error: Config file seems to be invalid (Missing Section 'main')\n")
-      exit(1)
-  return False
+      target.tz = lookupTimeZone(self.get(name, 'timezone', target.tz.reprname))
+      target.rate = float(self.get(name, 'rate', target.rate))
+      target.burst = int(self.get(name, 'burst', target.burst))
+    except ValueError, e:
+      sys.stderr.write("Error: Config file section '%s' is invalid (%s)\n" % (name, e))
+      exit(2)
+    return target
+
+  def targets(self, names, filenames, isGoogle=True):
+    """Returns the Targets of the profiles in names, in the order given, or
+    of every meter profile if names is empty."""
+    if len(names) == 0:
+      names = self.profiles()
+    return [self.target(name, filenames, isGoogle) for name in names]
+
+configs = dict()
 
-def getConfigfile(filename,var):
-  with open(filename) as f:
-    parser = cp.SafeConfigParser()
-    parser.readfp(f)
-    return parser.get('main',var)
-  return None
+def loadConfig(filename):
+  """Returns the Config of filename, reading the file on first use only."""
+  if filename not in configs:
+    configs[filename] = Config(filename)
+  return configs[filename]
+
+class Target:
+  """A meter to upload to, and the files holding its data.
+  Members:
+  name (str)\tConfig file section the meter came from
+  token (str)\tGoogle PowerMeter OAuth token
+  variable (str)\tGoogle PowerMeter variable
+  filenames (list(str))\tInput files for this meter
+  tz (USTimeZone)\tZone the times of the input files are in
+  rate (float)\tAverage number of readings uploaded per minute
+  burst (int)\tMost readings uploaded at once"""
+
+  def __init__(self, name, token, variable, filenames, tz=None, rate=100.0, burst=1000):
+    self.name = name
+    self.token = token
+    self.variable = variable
+    self.filenames = filenames
+    if tz is None:
+      tz = Pacific
+    self.tz = tz
+    self.rate = rate
+    self.burst = burst
 
 
 ZERO = timedelta(0)
@@ -197,6 +403,11 @@ DSTEND_1987_2006 = datetime(1, 10, 25, 1)
 DSTSTART_1967_1986 = datetime(1, 4, 24, 2)
 DSTEND_1967_1986 = DSTEND_1987_2006
 
+# Kinds of day, as far as DST is concerned.
+NORMAL_DAY = 'normal'
+SPRING_DAY = 'spring'
+FALL_DAY = 'fall'
+
 class USTimeZone(tzinfo):
 
     def __init__(self, hours, reprname, stdname, dstname):
@@ -204,6 +415,7 @@ class USTimeZone(tzinfo):
         self.reprname = reprname
         self.stdname = stdname
         self.dstname = dstname
+        self.transitions = dict()
 
     def __repr__(self):
         return self.reprname
@@ -226,19 +438,10 @@ class USTimeZone(tzinfo):
             return ZERO
         assert dt.tzinfo is self
 
-        # Find start and end times for US DST. For years before 1967, return
-        # ZERO for no DST.
-        if 2006 < dt.year:
-            dststart, dstend = DSTSTART_2007, DSTEND_2007
-        elif 1986 < dt.year < 2007:
-            dststart, dstend = DSTSTART_1987_2006, DSTEND_1987_2006
-        elif 1966 < dt.year < 1987:
-            dststart, dstend = DSTSTART_1967_1986, DSTEND_1967_1986
-        else:
+        bounds = self.dstTransitions(dt.year)
+        if bounds is None:
             return ZERO
-
-        start = first_sunday_on_or_after(dststart.replace(year=dt.year))
-        end = first_sunday_on_or_after(dstend.replace(year=dt.year))
+        start, end = bounds
 
         # Can't compare naive to aware objects, so strip the timezone from
         # dt first.
@@ -247,6 +450,58 @@ class USTimeZone(tzinfo):
         else:
             return ZERO
 
+    def dstTransitions(self, year):
+        """Returns the (start, end) of DST in year as naive local datetimes,
+        or None if there was no DST. Computed once per year, then cached."""
+        try:
+            return self.transitions[year]
+        except KeyError:
+            pass
+
+        # Find start and end times for US DST. For years before 1967, there
+        # is no DST.
+        if 2006 < year:
+            dststart, dstend = DSTSTART_2007, DSTEND_2007
+        elif 1986 < year < 2007:
+            dststart, dstend = DSTSTART_1987_2006, DSTEND_1987_2006
+        elif 1966 < year < 1987:
+            dststart, dstend = DSTSTART_1967_1986, DSTEND_1967_1986
+        else:
+            dststart = None
+
+        if dststart is None:
+            bounds = None
+        else:
+            bounds = (first_sunday_on_or_after(dststart.replace(year=year)),
+                      first_sunday_on_or_after(dstend.replace(year=year)))
+        self.transitions[year] = bounds
+        return bounds
+
+    def wallSeconds(self, seconds):
+        """Converts seconds since the epoch to local wall-clock time in this
+        zone, counted in seconds as if it were UTC. Local midnights are
+        then multiples of a day."""
+        standard = seconds + self.stdoffset.days * 86400 + self.stdoffset.seconds
+        bounds = self.dstTransitions(sleeptime.gmtime(standard).tm_year)
+        if bounds is None:
+            return standard
+        # DST starts at 2 AM standard time, and ends at 2 AM daylight
+        # time, i.e. 1 AM standard time, which is what the bounds hold.
+        if (calendar.timegm(bounds[0].timetuple()) <= standard
+            < calendar.timegm(bounds[1].timetuple())):
+            return standard + 3600
+        return standard
+
+    def classifyDay(self, day):
+        """Returns SPRING_DAY, FALL_DAY or NORMAL_DAY for the date day."""
+        bounds = self.dstTransitions(day.year)
+        if bounds is not None:
+            if day == bounds[0].date():
+                return SPRING_DAY
+            if day == bounds[1].date():
+                return FALL_DAY
+        return NORMAL_DAY
+
 class ZuluTimeZone(tzinfo):
     def __init__(self, hours, reprname, stdname, dstname):
         self.stdoffset = timedelta(hours=hours)
@@ -275,19 +530,31 @@ Central  = USTimeZone(-6, "Central",  "CST", "CDT")
 Mountain = USTimeZone(-7, "Mountain", "MST", "MDT")
 Pacific  = USTimeZone(-8, "Pacific",  "PST", "PDT")
 
+TIMEZONES = (Eastern, Central, Mountain, Pacific)
+
+def lookupTimeZone(name):
+  """Returns the USTimeZone called name (e.g. 'Pacific' or 'PST'),
+  ignoring case. Raises ValueError for unknown names."""
+  lowered = name.lower()
+  for tz in TIMEZONES:
+    if lowered in (tz.reprname.lower(), tz.stdname.lower(), tz.dstname.lower()):
+      return tz
+  raise ValueError("unknown timezone '%s'" % name)
+
 def parseHeader(row, headers):
+  """Stores a 'name,value' header row into headers. Raises ValueError for
+  a report this script can not read."""
   if (len(row) == 2):
     headers[row[0]] = row[1]
 
   if row[0] == 'Title':
-    if row[1] != 'Hourly Usage':
-      print 'Error: Input file is not "Hourly Usage"-type!'
-      exit(1)
+    # 'Hourly Usage', '15 Minute Usage' and so on; daily reports carry
+    # costs rather than interval data.
+    if not row[1].endswith('Usage') or row[1].startswith('Daily'):
+      raise ValueError('Input file is not an interval "Usage"-type (e.g. "Hourly Usage")!')
   elif row[0] == 'Primary Data Unit':
     if row[1] != 'kWh' and row[1] != 'k Wh':
-      print 'Error: Primary Data Unit is ' + row[1]
-      print 'Error: The only supported unit is kWh!'
-      exit(1)
+      raise ValueError('Primary Data Unit is %s; the only supported unit is kWh!' % row[1])
 
 def handleMissingData(row, days):
   """Removes the day element from days that corresponds to the missing data."""
@@ -296,8 +563,8 @@ def handleMissingData(row, days):
   #
   # Rather than taking PG&E's hint, we should handle this in parseToReadings
 
-def parseTimes(times):
-  # Parse the times
+def parseTimes(times, tz=Pacific):
+  # Parse the times, which are in the zone tz
   convTimes = list()
   times.pop(0) # Get rid of the header
   for timeElement in times:
@@ -314,13 +581,13 @@ def parseTimes(times):
     minute = int(minute)
 
     if ampm == 'AM' and hour == 12:
-      convTimes.append(time(0,minute,second,tzinfo=Pacific))
+      convTimes.append(time(0,minute,second,tzinfo=tz))
     else:
       if ampm == 'AM' or hour == 12:
-        convTimes.append(time(hour,minute,second,tzinfo=Pacific))
+        convTimes.append(time(hour,minute,second,tzinfo=tz))
       else:
         # We are PM, and not noon
-        convTimes.append(time(hour+12,minute,second,tzinfo=Pacific))
+        convTimes.append(time(hour+12,minute,second,tzinfo=tz))
   return convTimes
 
 def parseDay(row):
@@ -329,19 +596,18 @@ def parseDay(row):
   datestr = row.pop(0)
 
   dashcount = 0
-  readings = list()
+  valid = 0
+  readings = array('d')
   for reading in row:
     if reading != '-':
+      valid |= 1 << len(readings)
       readings.append(float(reading))
     else:
-      # TODO: We should simply ignore this data point.
-      #       This requires changing the dataflow, so that 'times' is passed in here
-      #       and the DurationalMeasurements are produced here rather than later.
-      readings.append(float(0))
+      # Missing; the slot is left out of valid so it is never uploaded.
+      readings.append(0.0)
       dashcount += 1
 
-  if dashcount == 24:
-    readings = list()
+  if dashcount == len(readings):
     print "Warning: Input file has no valid readings for %s." % datestr
 
   # Parse the date
@@ -353,17 +619,55 @@ def parseDay(row):
   day = day.replace('"','')
 	
   d = date(int(year),int(month),int(day))
-  return Day(d, readings)
+  return Day(d, readings, valid)
+
+class RowTemplate:
+  """Column layout compiled from a PG&E time header row, e.g.
+  'kWh,12:00 AM,1:00 AM,...'. It is built once per file and then decodes
+  each day row in one pass, giving the same result as parseDay().
+  Members:
+  times (list(datetime.time))\tStart of each column's timeslot
+  width (int)\tNumber of reading columns"""
+
+  def __init__(self, header, tz=Pacific):
+    self.times = parseTimes(list(header), tz)
+    self.width = len(self.times)
+
+  def decodeDay(self, row):
+    datestr = row[0]
+    values = row[1:]
+
+    missing = values.count('-')
+    if missing == 0:
+      readings = array('d', map(float, values))
+      valid = None
+    else:
+      # '-' marks a missing reading: stored as zero, and left out of valid.
+      readings = array('d', [value != '-' and float(value) or 0.0 for value in values])
+      valid = 0
+      for (i, value) in enumerate(values):
+        if value != '-':
+          valid |= 1 << i
+      if missing == len(values):
+        print "Warning: Input file has no valid readings for %s." % datestr
+
+    (month,day,year) = datestr.replace('"','').split('/')
+    return Day(date(int(year),int(month),int(day)), readings, valid)
 
 class Day:
   """Simple struct to hold a date and the electricity readings.
   Members:
   day (datetime.date)
-  readings (list(float))"""
+  readings (array('d'))
+  valid (int)\tBitmask of the readings that are present; bit i is set if
+  \treading i is. Missing readings are stored as zero."""
 
-  def __init__(self, day, readings):
+  def __init__(self, day, readings, valid=None):
     self.day = day
     self.readings = readings
+    if valid is None:
+      valid = (1 << len(readings)) - 1
+    self.valid = valid
 
 class DurationalMeasurement:
   """Struct to hold everything we need to know about a durational measurement.
@@ -384,176 +688,1565 @@ class DurationalMeasurement:
   def setUncertainty(self, uncertainty):
     self.uncertainty = uncertainty
 
-def isDSTBoundary(day):
-  dBefore = datetime(day.year,day.month,day.day,0,30,tzinfo=Pacific)
-  dAfter = datetime(day.year,day.month,day.day,3,30,tzinfo=Pacific)
-  
-  if Pacific.dst(dAfter) == Pacific.dst(dBefore):
-    return (False, None)
-  else:
-    if dAfter.utcoffset() == timedelta(days=-1,hours=17):
-      isSpring = True
+def serializeBatch(readings, kWh=None):
+  """Turns a ReadingStore into the argument tuples of Meter.PostDur(), one
+  per reading, in a single pass. Times are passed as POSIX timestamps,
+  which is what rfc3339.FromTimestamp() would make of their RFC 3339 text,
+  so no strings are built along the way. Energies are multiplied by kWh,
+  units.KILOWATT_HOUR unless given."""
+  if kWh is None:
+    import units
+    kWh = units.KILOWATT_HOUR
+  scaled = dict()
+  for uncertainty in set(readings.uncertainties):
+    scaled[uncertainty] = uncertainty * kWh
+  return [(float(start), float(end), energy * kWh, scaled[uncertainty])
+          for (start, end, energy, uncertainty) in readings]
+
+class ReadingStore:
+  """Columnar container of durational readings, backed by typed arrays
+  rather than one DurationalMeasurement object per hour.
+  Iterating yields (start, end, energy, uncertainty) tuples.
+  Members:
+  starts: (array('l'))\tStart of each duration, in seconds since the epoch
+  ends: (array('l'))\tEnd of each duration, in seconds since the epoch
+  energies: (array('d'))\tAmount of energy used in each duration (kWh)
+  uncertainties: (array('d'))\tUncertainty in each energy"""
+
+  def __init__(self):
+    self.starts = array('l')
+    self.ends = array('l')
+    self.energies = array('d')
+    self.uncertainties = array('d')
+
+  def __len__(self):
+    return len(self.starts)
+
+  def __iter__(self):
+    return izip(self.starts, self.ends, self.energies, self.uncertainties)
+
+  def add(self, start, end, energy, uncertainty=DurationalMeasurement.defaultUncertainty):
+    self.starts.append(start)
+    self.ends.append(end)
+    self.energies.append(energy)
+    self.uncertainties.append(uncertainty)
+
+  def sortByStart(self):
+    """Sorts the readings by start time. The sort is stable, so readings
+    with the same start keep the order they were added in."""
+    order = sorted(xrange(len(self.starts)), key=self.starts.__getitem__)
+    for column in ('starts', 'ends', 'energies', 'uncertainties'):
+      values = getattr(self, column)
+      setattr(self, column, array(values.typecode, [values[i] for i in order]))
+
+  def extendColumns(self, starts, ends, energies, uncertainties):
+    """Appends whole columns at once; all four must have the same length."""
+    self.starts.extend(starts)
+    self.ends.extend(ends)
+    self.energies.extend(energies)
+    self.uncertainties.extend(uncertainties)
+
+  def extend(self, rows):
+    """Appends rows, either another ReadingStore or an iterable of
+    (start, end, energy, uncertainty) tuples."""
+    if isinstance(rows, ReadingStore):
+      self.extendColumns(rows.starts, rows.ends, rows.energies, rows.uncertainties)
     else:
-      isSpring = False
-    return (True, isSpring)
-
-def processNormalDay(day, times):
-  measurements = list()
-  i = 0
-  for i in range(len(times)):
-    start = datetime.combine(day.day, times[i])
-    energy = day.readings[i]
-    if i != len(times) - 1:
-      end = datetime.combine(day.day, times[i+1])
+      for row in rows:
+        self.add(*row)
+
+class IntervalTemplate:
+  """Where each timeslot of a day falls, for any slot width. Built once
+  from the time header, after which converting a day costs one addition
+  per slot instead of a datetime per slot.
+  For every kind of day, a table gives the columns that exist on such a
+  day (None for all of them) and the start and end of each, in seconds
+  from UTC midnight of the date:
+    - standard and daylight days map wall time with a fixed offset;
+    - on the spring day, slots in the skipped hour are dropped;
+    - on the fall day, slots in the repeated hour hold both occurrences,
+      so they are stretched to twice their width.
+  Members:
+  tz (USTimeZone)\tZone the time header is in
+  width (int)\tNumber of timeslots in a day
+  tables (dict)\tKind of day -> (columns, starts, ends)"""
+
+  def __init__(self, times):
+    self.tz = times[0].tzinfo
+    self.width = len(times)
+    walls = [t.hour * 3600 + t.minute * 60 + t.second for t in times]
+    ends = walls[1:] + [walls[0] + 86400]
+
+    standard = -(self.tz.stdoffset.days * 86400 + self.tz.stdoffset.seconds)
+    daylight = standard - 3600
+    # All US rules switch at 2 AM standard time in spring, and at 2 AM
+    # daylight (1 AM standard) time in fall.
+    springGap = DSTSTART_2007.hour * 3600
+    fallRepeat = DSTEND_2007.hour * 3600
+
+    def springOffset(wall):
+      if wall <= springGap:
+        return wall + standard
+      return wall + daylight
+
+    def fallOffset(wall):
+      if wall < fallRepeat:
+        return wall + daylight
+      elif wall < fallRepeat + 3600:
+        return fallRepeat + daylight + 2 * (wall - fallRepeat)
+      return wall + standard
+
+    self.tables = dict()
+    self.tables['standard'] = self.table(walls, ends, lambda wall: wall + standard)
+    self.tables['daylight'] = self.table(walls, ends, lambda wall: wall + daylight)
+    self.tables[FALL_DAY] = self.table(walls, ends, fallOffset)
+    kept = [i for i in range(self.width) if not springGap <= walls[i] < springGap + 3600]
+    self.tables[SPRING_DAY] = self.table(walls, ends, springOffset, kept)
+
+  def table(self, walls, ends, offset, columns=None):
+    if columns is None:
+      indexes = range(len(walls))
     else:
-      end = datetime.combine(day.day, times[0]) + DAY
-    measurements.append(DurationalMeasurement(start,end,energy))
-  return measurements
-
-def processDSTDay(day, times, isSpring): 
-  measurements = list()
-
-  # TODO: This has to change if postings not hourly
-  if len(times) != 24:
-    sys.stderr.write("Error: DST transition on %s, but data is not strictly hourly.\n" % day)
-    sys.stderr.write('\tPlease make a patch and/or alert the project at:\n\thttp://gitorious.org/pge-to-google-powermeter/pages/Home\n')
-    sys.stderr.write('\tProcessing of other files will continue if possible.')
-    print len(times)
-    return measurements
-  # End TODO
-
-  if (isSpring):
-    # We are springing ahead, 2 AM becomes 3 AM.
-    # In PG&E's file, they have a '-' for 2 AM
-    for i in range(len(times)):
-      start = datetime.combine(day.day, times[i])
-      energy = day.readings[i]
-      if i == 1:
-        end = datetime.combine(day.day, times[i+2])
-      elif i == 2: #TODO: This has to change if postings not hourly
-        # Do nothing
-        print 'Info: Springing ahead 1 hour.'
-        continue
-      elif i == (len(times) - 1):
-        end = datetime.combine(day.day, times[0]) + DAY
+      indexes = columns
+    return (columns,
+            array('l', [offset(walls[i]) for i in indexes]),
+            array('l', [offset(ends[i]) for i in indexes]))
+
+  def kind(self, day):
+    """Returns the key of the table to use for the date day, from a single
+    lookup of the year's cached DST transitions."""
+    bounds = self.tz.dstTransitions(day.year)
+    if bounds is None:
+      return 'standard'
+    (spring, fall) = (bounds[0].date(), bounds[1].date())
+    if day == spring:
+      return SPRING_DAY
+    if day == fall:
+      return FALL_DAY
+    if spring < day < fall:
+      return 'daylight'
+    return 'standard'
+
+  def convert(self, day, kind, readings):
+    """Appends the valid readings of day (a Day) to readings (a
+    ReadingStore), copying each maximal run of valid slots at once.
+    Returns (missing, gaps): how many slots were missing, in how many runs."""
+    (columns, starts, ends) = self.tables[kind]
+    base = calendar.timegm(day.day.timetuple())
+    if columns is None:
+      energies = day.readings
+      valid = day.valid
+    else:
+      energies = array('d', [day.readings[i] for i in columns])
+      valid = 0
+      for (i, column) in enumerate(columns):
+        if day.valid >> column & 1:
+          valid |= 1 << i
+
+    count = len(starts)
+    gaps = 0
+    if valid == (1 << count) - 1:
+      runs = [(0, count)]
+    else:
+      runs = list()
+      i = 0
+      while i < count:
+        first = i
+        if valid >> i & 1:
+          while i < count and valid >> i & 1:
+            i += 1
+          runs.append((first, i))
+        else:
+          while i < count and not valid >> i & 1:
+            i += 1
+          gaps += 1
+
+    for (first, last) in runs:
+      readings.extendColumns(array('l', [base + offset for offset in starts[first:last]]),
+                             array('l', [base + offset for offset in ends[first:last]]),
+                             energies[first:last],
+                             array('d', [DurationalMeasurement.defaultUncertainty]) * (last - first))
+
+    present = sum([last - first for (first, last) in runs])
+    return (count - present, gaps)
+
+intervalTemplates = dict()
+
+def intervalTemplate(times):
+  """Returns the IntervalTemplate for times, building it on first use."""
+  key = (times[0].tzinfo, tuple(times))
+  if key not in intervalTemplates:
+    intervalTemplates[key] = IntervalTemplate(times)
+  return intervalTemplates[key]
+
+class Stats:
+  """Time spent, and rows and bytes handled, in each stage of a run.
+  Safe to update from several threads.
+  Members:
+  stages (dict)\tStage name -> [seconds, rows, bytes]
+  order (list(str))\tStage names, in the order they were first seen
+  counters (dict)\tOther counts, e.g. of missing readings"""
+
+  def __init__(self):
+    self.stages = dict()
+    self.order = list()
+    self.counters = dict()
+    self.lock = threading.Lock()
+
+  def add(self, stage, seconds, rows=0, size=0):
+    self.lock.acquire()
+    try:
+      if stage not in self.stages:
+        self.stages[stage] = [0.0, 0, 0]
+        self.order.append(stage)
+      counters = self.stages[stage]
+      counters[0] += seconds
+      counters[1] += rows
+      counters[2] += size
+    finally:
+      self.lock.release()
+
+  def count(self, name, n=1):
+    self.lock.acquire()
+    try:
+      self.counters[name] = self.counters.get(name, 0) + n
+    finally:
+      self.lock.release()
+
+  def merge(self, stages, order, counters):
+    """Adds the counters of another Stats (e.g. from a worker process)."""
+    for stage in order:
+      self.add(stage, *stages[stage])
+    for (name, n) in counters.items():
+      self.count(name, n)
+
+  def reset(self):
+    self.lock.acquire()
+    try:
+      self.stages = dict()
+      self.order = list()
+      self.counters = dict()
+    finally:
+      self.lock.release()
+
+  def printTable(self):
+    print '%-26s %10s %10s %14s' % ('stage', 'seconds', 'rows', 'bytes')
+    for stage in self.order:
+      (seconds, rows, size) = self.stages[stage]
+      print '%-26s %10.3f %10d %14d' % (stage, seconds, rows, size)
+    for name in sorted(self.counters):
+      print '%-26s %10s %10d' % (name, '', self.counters[name])
+
+  def write(self, filename):
+    """Writes the counters to filename: a Prometheus textfile if the name
+    ends in .prom, JSON otherwise."""
+    with open(filename, 'w') as f:
+      if filename.endswith('.prom'):
+        for (index, metric, description) in ((0, 'seconds', 'Seconds spent in the stage'),
+                                      (1, 'rows', 'Rows handled by the stage'),
+                                      (2, 'bytes', 'Bytes handled by the stage')):
+          name = '%s_stage_%s_total' % (programName, metric)
+          f.write('# HELP %s %s.\n' % (name, description))
+          f.write('# TYPE %s counter\n' % name)
+          for stage in self.order:
+            f.write('%s{stage="%s"} %r\n' % (name, stage, self.stages[stage][index]))
+        for counter in sorted(self.counters):
+          name = '%s_%s_total' % (programName, counter)
+          f.write('# TYPE %s counter\n' % name)
+          f.write('%s %d\n' % (name, self.counters[counter]))
       else:
-        end = datetime.combine(day.day, times[i+1])
-      measurements.append(DurationalMeasurement(start,end,energy))
+        stages = dict()
+        for stage in self.order:
+          (seconds, rows, size) = self.stages[stage]
+          stages[stage] = {'seconds': seconds, 'rows': rows, 'bytes': size}
+        json.dump({'stages': stages, 'order': self.order, 'counters': self.counters},
+                  f, indent=2, sort_keys=True)
+        f.write('\n')
+
+STATS = Stats()
+
+class InputLines:
+  """Iterates the lines of a file object, reading it in large chunks so
+  that compressed data is decoded in bulk and memory stays bounded.
+  Members:
+  name (str)\tName of the input, for messages
+  f (file)\tThe file object read
+  size (int)\tBytes read so far"""
+
+  chunkSize = 1 << 20
+
+  def __init__(self, name, f):
+    self.name = name
+    self.f = f
+    self.size = 0
+
+  def __iter__(self):
+    pending = ''
+    while True:
+      chunk = self.f.read(InputLines.chunkSize)
+      if not chunk:
+        break
+      self.size += len(chunk)
+      lines = (pending + chunk).split('\n')
+      pending = lines.pop()
+      for line in lines:
+        yield line + '\n'
+    if pending:
+      yield pending
+
+def isArchive(filename):
+  """True if filename may hold several CSV files."""
+  return filename.lower().endswith('.zip')
+
+def openInputs(filename):
+  """Generates an InputLines for each CSV file in filename: the file itself,
+  its content if it is gzip, bzip2 or xz compressed, or each member if it
+  is a zip archive. Everything is decompressed on the fly; nothing is
+  extracted to disk."""
+  lowered = filename.lower()
+  if isArchive(filename):
+    archive = zipfile.ZipFile(filename)
+    try:
+      for member in archive.namelist():
+        if member.endswith('/'):
+          continue
+        f = archive.open(member)
+        try:
+          yield InputLines('%s:%s' % (filename, member), f)
+        finally:
+          f.close()
+    finally:
+      archive.close()
+    return
+
+  if lowered.endswith('.gz'):
+    f = gzip.open(filename, 'rb')
+  elif lowered.endswith('.bz2'):
+    f = bz2.BZ2File(filename, 'r')
+  elif lowered.endswith(('.xz', '.lzma')):
+    if lzma is None:
+      sys.stderr.write("Error: Reading '%s' needs the lzma module (backports.lzma on Python 2).\n" % filename)
+      return
+    f = lzma.open(filename, 'rb')
   else:
-    # We are Falling behind. 3 am becomes 2 AM.
-    # In PG&E's file, the 1 AM-2 AM slot has 2 hours worth of data
-    # So it is really 1 AM - 3 AM, in a DSTless world.
-    for i in range(len(times)):
-      start = datetime.combine(day.day, times[i])
-      energy = day.readings[i]
-      if i == 0:
-        end = datetime.combine(day.day, time(8,0,0,tzinfo=Zulu))
-      elif i == 1: #TODO: This has to change if postings not hourly
-        print 'Info: Falling behind 1 hour.'
-        start = datetime.combine(day.day, time(8,0,0,tzinfo=Zulu))
-        end = datetime.combine(day.day, time(10,0,0,tzinfo=Zulu))
-      elif i == (len(times)-1):
-        end = datetime.combine(day.day, times[0]) + DAY
+    f = open(filename, 'rb')
+  try:
+    yield InputLines(filename, f)
+  finally:
+    f.close()
+
+def iterDays(lines, times, tz=Pacific):
+  """Generator over the Day rows of a PG&E CSV file, given as an
+  InputLines, whose times are in the zone tz. The time header is stored
+  into times (a list) as soon as it is read, so it is available before the
+  first Day is yielded."""
+  csvReader = csv.reader(lines,delimiter=',',quotechar='"')
+  headers = dict()
+  template = None
+  clock = sleeptime.time
+  start = clock()
+
+  for row in csvReader:
+    if len(row) == 0:
+      continue
+    first = row[0]
+    if '/' not in first: # Test for date field, e.g. 3/14/2010
+      if first.startswith('kWh'): # Time header's first field
+        template = RowTemplate(row, tz)
+        times[:] = template.times
+      else:
+        parseHeader(row, headers)
+    # Following two tests weed out info from Daily reports.
+    elif first.startswith(('Cost', 'per kWh')):
+      continue
+    elif len(row) > 1 and '$' in row[1]:
+      continue
+    elif first.startswith('Missing data'):
+      handleMissingData(row, None)
+    else:
+      if template is not None:
+        day = template.decodeDay(row)
       else:
-        end = datetime.combine(day.day, times[i+1])
-      measurements.append(DurationalMeasurement(start,end,energy))                           
-  return measurements
+        day = parseDay(row)
+      STATS.add('csv_parse', clock() - start, 1)
+      yield day
+      start = clock()
+  STATS.add('csv_parse', clock() - start, 0, lines.size)
 
-def readfile(filename):
-  with open(filename, 'r') as f:
-    csvReader = csv.reader(f,delimiter=',',quotechar='"')
-    times = list()
-    days = list()
-    headers = dict()
-
-    for row in csvReader:
-      if len(row) > 0:
-        if row[0].count('/') == 0: # Test for date field, e.g. 3/14/2010
-          if not row[0].startswith('kWh'): # Time header's first field
-            parseHeader(row, headers)
-          else:
-            times = parseTimes(row)
-        else:
-          # Following two if statements weed out info from Daily reports.
-          if row[0].startswith('Cost') or row[0].startswith('per kWh'):
-            continue
-          if len(row) > 1:
-            if row[1].count('$') > 0:
-              continue
-          if not row[0].startswith('Missing data'):
-            days.append(parseDay(row))
-          else:
-            handleMissingData(row, days)
-    return (times, days)
-            
-def parseToReadings(times, days):
-  readings = list()
+def readfile(filename, tz=Pacific):
+  """Returns the time header and the Days of filename, whose times are in
+  the zone tz. The members of an archive are all read, and assumed to
+  share one time header."""
+  times = list()
+  days = list()
+  for lines in openInputs(filename):
+    days.extend(iterDays(lines, times, tz))
+  return (times, days)
+
+def convertDays(times, days, readings, counts=None):
+  """Appends the readings of days to readings (a ReadingStore). Returns
+  the number of days converted, i.e. not rejected for having a reading
+  count that does not match times. Missing readings and gaps are counted
+  in STATS, and also added to counts (a dict) if given."""
+  if len(times) == 0:
+    return 0
+  template = intervalTemplate(times)
+  clock = sleeptime.time
+  converted = 0
   for day in days:
     if len(day.readings) == len(times):
-      (isDST, isSpring) = isDSTBoundary(day.day)
-      if isDST:
-        for measurement in processDSTDay(day, times, isSpring):
-          readings.append(measurement)
-      else:
-        for measurement in processNormalDay(day,times):
-          readings.append(measurement)
+      converted += 1
+      start = clock()
+      kind = template.kind(day.day)
+      classified = clock()
+      STATS.add('dst_classification', classified - start, 1)
+      if kind == SPRING_DAY:
+        print 'Info: Springing ahead 1 hour on %s.' % day.day.isoformat()
+      elif kind == FALL_DAY:
+        print 'Info: Falling behind 1 hour on %s.' % day.day.isoformat()
+      count = len(readings)
+      (missing, gaps) = template.convert(day, kind, readings)
+      STATS.add('measurement_construction', clock() - classified, len(readings) - count,
+                day.readings.itemsize * len(day.readings))
+      if missing > 0:
+        STATS.count('missing_readings', missing)
+        STATS.count('gaps', gaps)
+        if counts is not None:
+          counts['missing_readings'] += missing
+          counts['gaps'] += gaps
     elif len(day.readings) > 0:
-      print "Warning: There are %d energy readings but %d associated timeslots for day %s." % (len(readings),len(times),day.day.isoformat())
+      print "Warning: There are %d energy readings but %d associated timeslots for day %s." % (len(day.readings),len(times),day.day.isoformat())
       print '\tPlease upload your data file to the wiki (strip sensitive info!), and/or provide a patch to handle your input.'
-  return readings
-
-if __name__ == '__main__':
-  (filenames, options) = parseArguments()
+  return converted
 
-  token = options.token
-  variable = options.variable
-  readings = list()
+def parseToReadings(times, days):
+  readings = ReadingStore()
+  convertDays(times, days, readings)
+  return readings
 
-  for filename in filenames:
-    (times, days) = readfile(filename)
+def iterFileDays(filename, tz=Pacific):
+  """Generates (times, day) for every Day of a file (or of every file in
+  an archive), and reports inputs without a time header or without any
+  usage data."""
+  for lines in openInputs(filename):
+    times = list()
+    dayCount = 0
+    for day in iterDays(lines, times, tz):
+      dayCount += 1
+      yield (times, day)
 
     if len(times) <= 0:
       sys.stderr.write('Error: Read input file, but never read the time header.\n')
-      sys.stderr.write("Ignoring file '%s'\n" % filename)
-      continue
-    if len(days) <= 0:
+      sys.stderr.write("Ignoring file '%s'\n" % lines.name)
+    elif dayCount <= 0:
       sys.stderr.write('Error: Read input file, but never parsed any electricity usage data.\n')
-      sys.stderr.write("Ignoring file '%s'\n" % filename)
-      continue
+      sys.stderr.write("Ignoring file '%s'\n" % lines.name)
+
+def streamReadings(filenames, tz=Pacific):
+  """Generates the (start, end, energy, uncertainty) rows of every file in
+  filenames, in the same layout as iterating over a ReadingStore.
+  Rows are read, parsed and converted lazily, so nothing is held in memory
+  beyond the day currently being processed."""
+  for filename in filenames:
+    for (times, day) in iterFileDays(filename, tz):
+      readings = ReadingStore()
+      convertDays(times, [day], readings)
+      for row in readings:
+        yield row
 
-    readings.extend(parseToReadings(times, days))
-  
-      
-  print "Info: Processed %d durational readings. Now attempting to upload to Google." % len(readings)
+class ReadingCache:
+  """Directory of ReadingStores already parsed from input files, keyed by
+  the SHA-1 of each file's content, so unchanged files are never parsed
+  twice. Entries are a small header, which also holds how many readings
+  the file was missing and in how many gaps, followed by the raw column
+  arrays, and are read back through mmap. The least recently used entries are removed
+  once the directory grows past maxBytes.
+  Members:
+  directory (str)\tWhere the entries are kept
+  maxBytes (int)\tSize the directory is kept under"""
 
+  # Bump whenever parsing or the entry layout changes.
+  version = 2
+  magic = 'PGR%d' % version
+  header = struct.Struct('<4sQBBQQ')
+
+  def __init__(self, directory, maxBytes):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def key(self, filename, tz=Pacific):
+    digest = hashlib.sha1()
+    # The same file read in another zone gives other readings.
+    digest.update(tz.reprname)
+    with open(filename, 'rb') as f:
+      while True:
+        chunk = f.read(1 << 20)
+        if not chunk:
+          break
+        digest.update(chunk)
+    return digest.hexdigest()
+
+  def path(self, key):
+    return os.path.join(self.directory, '%s.readings' % key)
+
+  def load(self, key):
+    """Returns the (ReadingStore, missing readings, gaps) cached under key,
+    or None."""
+    path = self.path(key)
+    try:
+      f = open(path, 'rb')
+    except IOError:
+      return None
+    with f:
+      size = os.fstat(f.fileno()).st_size
+      if size < ReadingCache.header.size:
+        return None
+      data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+      try:
+        (magic, count, longSize, doubleSize, missing, gaps) = ReadingCache.header.unpack_from(data)
+        readings = ReadingStore()
+        if (magic != ReadingCache.magic or longSize != readings.starts.itemsize
+            or doubleSize != readings.energies.itemsize):
+          return None
+        offset = ReadingCache.header.size
+        for column in (readings.starts, readings.ends, readings.energies, readings.uncertainties):
+          length = count * column.itemsize
+          column.fromstring(data[offset:offset + length])
+          offset += length
+      finally:
+        data.close()
+    # Mark the entry as recently used.
+    os.utime(path, None)
+    return (readings, missing, gaps)
+
+  def store(self, key, readings, missing=0, gaps=0):
+    (fd, temporary) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+      f.write(ReadingCache.header.pack(ReadingCache.magic, len(readings),
+                                       readings.starts.itemsize, readings.energies.itemsize,
+                                       missing, gaps))
+      for column in (readings.starts, readings.ends, readings.energies, readings.uncertainties):
+        column.tofile(f)
+    os.rename(temporary, self.path(key))
+    self.evict()
+
+  def evict(self):
+    """Removes the least recently used entries until under maxBytes."""
+    entries = list()
+    total = 0
+    for name in os.listdir(self.directory):
+      if not name.endswith('.readings'):
+        continue
+      try:
+        stat = os.stat(os.path.join(self.directory, name))
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, name))
+      total += stat.st_size
+    entries.sort()
+    for (mtime, size, name) in entries:
+      if total <= self.maxBytes:
+        break
+      try:
+        os.remove(os.path.join(self.directory, name))
+      except OSError:
+        pass
+      total -= size
+
+def loadFile(filename, cache=None, tz=Pacific):
+  """Reads and converts a single file, whose times are in the zone tz, into
+  a ReadingStore, going through cache (a ReadingCache) if there is one."""
+  if cache is not None:
+    start = sleeptime.time()
+    key = cache.key(filename, tz)
+    entry = cache.load(key)
+    if entry is not None:
+      (readings, missing, gaps) = entry
+      STATS.add('cache_load', sleeptime.time() - start, len(readings), os.path.getsize(cache.path(key)))
+      if missing > 0:
+        STATS.count('missing_readings', missing)
+        STATS.count('gaps', gaps)
+      return readings
+
+  readings = ReadingStore()
+  counts = {'missing_readings': 0, 'gaps': 0}
+  for (times, day) in iterFileDays(filename, tz):
+    convertDays(times, [day], readings, counts)
+  if cache is not None:
+    cache.store(key, readings, counts['missing_readings'], counts['gaps'])
+  return readings
+
+def loadFileWithStats(job):
+  """loadFile() for worker processes, taking a (filename, cache, zone name)
+  tuple; zones go by name, since tzinfo objects do not pickle. Also
+  returns the worker's Stats counters, so the parent can add them to its
+  own."""
+  STATS.reset()
+  (filename, cache, tzName) = job
+  readings = loadFile(filename, cache, lookupTimeZone(tzName))
+  return (readings, STATS.stages, STATS.order, STATS.counters)
+
+DEDUP_POLICIES = ('latest', 'first', 'nonzero')
+
+def mergeReadings(sources, policy='latest', counts=None):
+  """k-way merge of several time-ordered sources of readings (ReadingStores
+  or iterables of their rows), generating one time-ordered stream of rows.
+  Readings with the same start are duplicates, of which one is kept as
+  chosen by policy, counting sources in the order given:
+    latest\tthe one from the last source
+    first\tthe one from the first source
+    nonzero\tthe one from the last source with non-zero energy, if any
+  A reading starting before the end of the one kept before it overlaps
+  it and is dropped, so the result never goes back in time.
+  If counts (a dict) is given, the number of duplicates, conflicts (i.e.
+  duplicates whose energies differ) and overlaps are added to it."""
+  if counts is None:
+    counts = dict()
+  for key in ('duplicates', 'conflicts', 'overlaps'):
+    counts.setdefault(key, 0)
+
+  def tagged(index, source):
+    for row in source:
+      yield (row[0], index, row)
+
+  merged = heapq.merge(*[tagged(index, source) for (index, source) in enumerate(sources)])
+  lastEnd = None
+  group = list()
+  # The trailing None closes the last group.
+  for item in chain(merged, [None]):
+    if group and (item is None or item[0] != group[0][0]):
+      kept = pickDuplicate(group, policy, counts)
+      if lastEnd is not None and kept[0] < lastEnd:
+        counts['overlaps'] += 1
+      else:
+        lastEnd = kept[1]
+        yield kept
+      group = list()
+    group.append(item)
+
+def pickDuplicate(group, policy, counts):
+  """Returns the row to keep out of group, a list of (start, source, row)
+  sharing the same start, in source order."""
+  if len(group) > 1:
+    counts['duplicates'] += len(group) - 1
+    if len(set([item[2][2] for item in group])) > 1:
+      counts['conflicts'] += 1
+  if policy == 'first':
+    return group[0][2]
+  if policy == 'nonzero':
+    for item in reversed(group):
+      if item[2][2] != 0:
+        return item[2]
+  return group[-1][2]
+
+def loadFiles(filenames, jobs=1, cache=None, policy='latest', tz=Pacific):
+  """Reads and converts every file in filenames, using up to jobs worker
+  processes. The files are merged into one ReadingStore in time order,
+  and readings found in several files, or in several members of one
+  archive, are kept once (see mergeReadings)."""
+  if jobs > 1 and len(filenames) > 1:
+    pool = multiprocessing.Pool(min(jobs, len(filenames)))
+    try:
+      results = pool.map(loadFileWithStats, [(filename, cache, tz.reprname) for filename in filenames])
+    finally:
+      pool.close()
+      pool.join()
+    stores = list()
+    for (store, stages, order, counters) in results:
+      stores.append(store)
+      STATS.merge(stages, order, counters)
+  else:
+    stores = [loadFile(filename, cache, tz) for filename in filenames]
+
+  for store in stores:
+    store.sortByStart()
+  readings = ReadingStore()
+  if len(stores) == 1 and not isArchive(filenames[0]):
+    readings.extend(stores[0])
+  else:
+    counts = dict()
+    readings.extend(mergeReadings(stores, policy, counts))
+    reportMerge(counts)
+  return readings
+
+def reportMerge(counts):
+  """Prints what mergeReadings() dropped, from the counts it filled in."""
+  if counts['duplicates'] > 0 or counts['overlaps'] > 0:
+    print "Info: Dropped %d duplicate (%d conflicting) and %d overlapping durational readings." % (
+        counts['duplicates'], counts['conflicts'], counts['overlaps'])
+
+def checkTimeOrder(rows, filename):
+  """Passes rows through, warning once if they go back in time.
+  mergeReadings() needs time-ordered sources; it drops the rows of an
+  unordered one as overlaps, which only sorting (i.e. not streaming)
+  avoids."""
+  isOrdered = True
+  lastStart = None
+  for row in rows:
+    if isOrdered and lastStart is not None and row[0] < lastStart:
+      sys.stderr.write("Warning: '%s' is not in time order; --stream drops the readings that go back in time. Run without --stream to keep them.\n" % filename)
+      isOrdered = False
+    lastStart = row[0]
+    yield row
+
+def rollupReadings(readings, seconds, tz=None):
+  """Merges contiguous readings into coarser measurements, each within one
+  period of the given number of seconds. Periods are aligned on the local
+  midnights of tz (a USTimeZone), following DST, or on UTC midnights if
+  tz is None.
+  readings must be in time order, and may be a ReadingStore or any iterable
+  of its rows; the merged rows are generated in the same layout.
+  Energies are summed; uncertainties are assumed independent, so they add
+  in quadrature."""
+  period = None
+  for (start, end, energy, uncertainty) in readings:
+    if tz is not None:
+      startPeriod = tz.wallSeconds(start) // seconds
+    else:
+      startPeriod = start // seconds
+    if period is not None and (startPeriod != period or start != runEnd):
+      yield (runStart, runEnd, energySum, math.sqrt(varianceSum))
+      period = None
+    if period is None:
+      period = startPeriod
+      runStart = start
+      energySum = 0.0
+      varianceSum = 0.0
+    runEnd = end
+    energySum += energy
+    varianceSum += uncertainty * uncertainty
+  if period is not None:
+    yield (runStart, runEnd, energySum, math.sqrt(varianceSum))
+
+class UploadScheduler:
+  """Token bucket deciding when a batch may be flushed, so we post as fast
+  as Google allows without being rejected for posting too fast.
+  A failed flush halves the rate and is retried after an exponentially
+  growing backoff; each successful flush wins back some of the rate.
+  Members:
+  rate (float)\tReadings allowed per second right now
+  maxRate (float)\tConfigured readings per second
+  burst (int)\tSize of the bucket, i.e. most readings sent at once
+  tokens (float)\tReadings that may be sent immediately
+  backoff (float)\tSeconds to wait before retrying the next failed flush
+  lastLatency (float)\tSeconds the last successful Flush() call took
+  lastRetries (int)\tFailed attempts before the last successful flush"""
+
+  minBackoff = 60.0
+  maxBackoff = 3600.0
+  maxRetries = 6
+
+  def __init__(self, rate, burst, clock=sleeptime.time, sleep=sleeptime.sleep):
+    self.rate = rate
+    self.maxRate = rate
+    self.burst = burst
+    self.tokens = float(burst)
+    self.backoff = UploadScheduler.minBackoff
+    self.clock = clock
+    self.sleep = sleep
+    self.last = clock()
+    self.lastLatency = 0.0
+    self.lastRetries = 0
+
+  def refill(self):
+    now = self.clock()
+    self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+    self.last = now
+
+  def acquire(self, count):
+    """Waits until count readings (at most burst) may be sent, and takes them."""
+    count = min(count, self.burst)
+    self.refill()
+    if self.tokens < count:
+      wait = (count - self.tokens) / self.rate
+      print "Info: Waiting %d seconds for upload quota." % wait
+      self.sleep(wait)
+      STATS.add('sleep', wait)
+      self.refill()
+    self.tokens -= count
+
+  def flush(self, service):
+    """Calls service.Flush(), retrying with backoff when it fails."""
+    retries = 0
+    while True:
+      start = self.clock()
+      try:
+        result = service.Flush()
+      except Exception, e:
+        STATS.add('flush_failed', self.clock() - start, 1)
+        retries += 1
+        if retries > UploadScheduler.maxRetries:
+          raise
+        self.rate = max(self.rate / 2, self.maxRate / 64)
+        sys.stderr.write("Warning: Upload failed (%s); retrying in %d seconds.\n" % (e, self.backoff))
+        self.sleep(self.backoff)
+        STATS.add('sleep', self.backoff)
+        self.backoff = min(self.backoff * 2, UploadScheduler.maxBackoff)
+        self.refill()
+        continue
+      self.lastLatency = self.clock() - start
+      self.lastRetries = retries
+      STATS.add('flush', self.lastLatency, 1)
+      self.backoff = UploadScheduler.minBackoff
+      self.rate = min(self.maxRate, self.rate * 1.25)
+      return result
+
+class BatchSizer:
+  """Adapts how many readings go into each flush to how the service copes.
+  The size grows by a tenth after a clean flush quicker than
+  targetLatency. It shrinks in proportion after a slower one, and halves
+  after a flush that needed retries.
+  Members:
+  size (int)\tReadings in the next batch
+  minimum (int)\tSmallest batch size
+  maximum (int)\tLargest batch size
+  targetLatency (float)\tSeconds a flush should take"""
+
+  def __init__(self, size, minimum, maximum, targetLatency):
+    self.size = size
+    self.minimum = minimum
+    self.maximum = maximum
+    self.targetLatency = targetLatency
+
+  def observe(self, latency, retries):
+    """Adjusts size after a flush that took latency seconds on its last
+    attempt, after retries failed ones."""
+    if retries > 0:
+      size = self.size // 2
+    elif latency > self.targetLatency:
+      size = int(self.size * self.targetLatency / latency)
+    else:
+      size = self.size + max(1, self.size // 10)
+    self.size = max(self.minimum, min(self.maximum, size))
+
+class UploadLedger:
+  """On-disk record of the intervals already posted to Google, keyed by
+  variable, so interrupted or repeated runs only send what is new. An
+  interval may be a single reading or a rolled-up measurement covering
+  several; a reading is uploaded if its start falls in any of them.
+  Members:
+  path (str)\tLocation of the SQLite database
+  cache (dict)\tVariable -> dict of the start -> end of its intervals
+  sorted (dict)\tVariable -> sorted array('l') of those starts, rebuilt
+  \tafter a record()"""
+
+  def __init__(self, path):
+    self.path = path
+    self.connection = sqlite3.connect(path)
+    self.connection.execute('CREATE TABLE IF NOT EXISTS uploaded ('
+                            'variable TEXT NOT NULL, start INTEGER NOT NULL, '
+                            'PRIMARY KEY (variable, start))')
+    # Ledgers from before rollups only knew starts; their intervals end
+    # where they start, so only that exact start counts as uploaded.
+    columns = [row[1] for row in self.connection.execute('PRAGMA table_info(uploaded)')]
+    if 'end' not in columns:
+      self.connection.execute('ALTER TABLE uploaded ADD COLUMN end INTEGER')
+    self.connection.commit()
+    self.cache = dict()
+    self.sorted = dict()
+
+  def uploaded(self, variable):
+    """Returns the start -> end of the intervals already uploaded for
+    variable."""
+    if variable not in self.cache:
+      cursor = self.connection.execute('SELECT start, end FROM uploaded WHERE variable = ?', (variable,))
+      intervals = dict()
+      for (start, end) in cursor:
+        intervals[start] = end
+      self.cache[variable] = intervals
+    return self.cache[variable]
+
+  def contains(self, variable, start):
+    """True if a reading starting at start was already uploaded."""
+    intervals = self.uploaded(variable)
+    if start in intervals:
+      return True
+    if variable not in self.sorted:
+      self.sorted[variable] = array('l', sorted(intervals))
+    starts = self.sorted[variable]
+    i = bisect.bisect_right(starts, start) - 1
+    if i < 0:
+      return False
+    end = intervals[starts[i]]
+    return end is not None and start < end
+
+  def record(self, variable, starts, ends):
+    """Marks the intervals from starts to ends as uploaded for variable.
+    Call only after a successful flush."""
+    rows = [(variable, start, end) for (start, end) in izip(starts, ends)]
+    self.connection.executemany('INSERT OR REPLACE INTO uploaded (variable, start, end) VALUES (?, ?, ?)', rows)
+    self.connection.commit()
+    self.uploaded(variable).update(izip(starts, ends))
+    self.sorted.pop(variable, None)
+
+  def close(self):
+    self.connection.close()
+
+class GoogleSink:
+  """Sends readings to a Google PowerMeter meter. A batch is flushed as
+  soon as the scheduler has quota for it.
+  Members:
+  meter (google_meter.Meter)\tMeter the readings are posted to
+  service (google_meter.BatchAdapter)\tService flushed after each batch
+  batchSize (int)\tNumber of readings per flush
+  scheduler (UploadScheduler)\tDecides when each batch may be flushed
+  sizer (BatchSizer)\tAdapts the batch size, or None for batchSize
+  kWh (units.Unit)\tUnit the energies are posted in, or None for
+  \tunits.KILOWATT_HOUR"""
+
+  destination = 'Google'
+
+  def __init__(self, meter, service, batchSize=1000, scheduler=None, sizer=None, kWh=None):
+    self.meter = meter
+    self.kWh = kWh
+    self.service = service
+    self.batchSize = batchSize
+    if scheduler is None:
+      scheduler = UploadScheduler(batchSize / 600.0, batchSize)
+    self.scheduler = scheduler
+    self.sizer = sizer
+
+  def batchLimit(self):
+    if self.sizer is not None:
+      return self.sizer.size
+    return self.batchSize
+
+  def write(self, readings):
+    start = sleeptime.time()
+    batch = serializeBatch(readings, self.kWh)
+    STATS.add('serialization', sleeptime.time() - start, len(batch),
+              sum([column.itemsize * len(column) for column in
+                   (readings.starts, readings.ends, readings.energies, readings.uncertainties)]))
+    for args in batch:
+      self.meter.PostDur(*args)
+    self.scheduler.acquire(len(readings))
+    self.scheduler.flush(self.service)
+    if self.sizer is not None:
+      self.sizer.observe(self.scheduler.lastLatency, self.scheduler.lastRetries)
+
+  def close(self):
+    pass
+
+class NullSink:
+  """Discards readings, for --debug runs: no connection, no quota, no
+  waiting."""
+
+  destination = 'nowhere (--debug)'
+
+  def batchLimit(self):
+    return FileSink.batchSize
+
+  def write(self, readings):
+    pass
+
+  def close(self):
+    pass
+
+def isoTime(seconds):
+  """RFC 3339 text, in UTC, for seconds since the epoch."""
+  return sleeptime.strftime('%Y-%m-%dT%H:%M:%SZ', sleeptime.gmtime(seconds))
+
+class FileSink:
+  """Writes readings to a file, in large batches, instead of uploading
+  them. Subclasses define the format.
+  Members:
+  filename (str)\tFile written
+  f (file)\tThe open file"""
+
+  batchSize = 65536
+  mode = 'w'
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.destination = "'%s'" % filename
+    self.f = open(filename, self.mode)
+    self.writeHeader()
+
+  def batchLimit(self):
+    return FileSink.batchSize
+
+  def writeHeader(self):
+    pass
+
+  def write(self, readings):
+    start = sleeptime.time()
+    offset = self.f.tell()
+    self.writeRows(readings)
+    STATS.add('export', sleeptime.time() - start, len(readings), self.f.tell() - offset)
+
+  def close(self):
+    self.f.close()
+
+class CsvSink(FileSink):
+  """One line per reading: start,end,kWh,uncertainty, with the times in
+  RFC 3339 (UTC)."""
+
+  def writeHeader(self):
+    self.f.write('start,end,kWh,uncertainty\n')
+
+  def writeRows(self, readings):
+    self.f.write(''.join(['%s,%s,%r,%r\n' % (isoTime(start), isoTime(end), energy, uncertainty)
+                          for (start, end, energy, uncertainty) in readings]))
+
+class JsonlSink(FileSink):
+  """One JSON object per line, with the times in RFC 3339 (UTC)."""
+
+  def writeRows(self, readings):
+    self.f.write(''.join(['{"start": "%s", "end": "%s", "kWh": %r, "uncertainty": %r}\n' % (
+                              isoTime(start), isoTime(end), energy, uncertainty)
+                          for (start, end, energy, uncertainty) in readings]))
+
+class BinarySink(FileSink):
+  """A magic string, then one little-endian record per reading: start and
+  end as 64-bit seconds since the epoch, kWh and uncertainty as doubles."""
+
+  mode = 'wb'
+  magic = 'PGB1'
+  record = struct.Struct('<qqdd')
+
+  def writeHeader(self):
+    self.f.write(BinarySink.magic)
+
+  def writeRows(self, readings):
+    pack = BinarySink.record.pack
+    self.f.write(''.join([pack(*row) for row in readings]))
+
+# Output formats, and the file extension each one is picked for.
+SINK_FORMATS = {'csv': CsvSink, 'jsonl': JsonlSink, 'binary': BinarySink}
+SINK_EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.json': 'jsonl'}
+
+class Uploader:
+  """Hands readings (a ReadingStore, or any iterable of its rows) to a
+  sink, in batches of the size the sink asks for.
+  Members:
+  sink (GoogleSink, FileSink or NullSink)\tWhere the readings go
+  variable (str)\tGoogle PowerMeter variable, used as the ledger key
+  ledger (UploadLedger)\tRecord of uploaded intervals, or None
+  posted (int)\tReadings posted so far
+  skipped (int)\tReadings skipped by unsent() because the ledger had them"""
+
+  def __init__(self, sink, variable, ledger=None):
+    self.sink = sink
+    self.variable = variable
+    self.ledger = ledger
+    self.posted = 0
+    self.skipped = 0
+    self.batch = ReadingStore()
+
+  def unsent(self, readings):
+    """Returns readings without those the ledger has, keeping a
+    ReadingStore a ReadingStore and a stream a stream. Call it before
+    rolling readings up, so the ledger is checked slot by slot."""
+    if self.ledger is None:
+      return readings
+    rows = self.filterUnsent(readings)
+    if not isinstance(readings, ReadingStore):
+      return rows
+    unsent = ReadingStore()
+    unsent.extend(rows)
+    return unsent
+
+  def filterUnsent(self, readings):
+    for row in readings:
+      if self.ledger.contains(self.variable, row[0]):
+        self.skipped += 1
+        continue
+      yield row
+
+  def upload(self, readings):
+    """Posts and flushes readings, which unsent() has already checked
+    against the ledger. Returns the number of readings posted."""
+    posted = self.posted
+    for (dStart, dEnd, energy, uncertainty) in readings:
+      self.batch.add(dStart, dEnd, energy, uncertainty)
+      if len(self.batch) >= self.sink.batchLimit():
+        self.flush()
+        print "Uploaded %d measurements so far." % self.posted
+    self.flush()
+    return self.posted - posted
+
+  def flush(self):
+    """Writes the pending batch to the sink, then records it in the ledger."""
+    if len(self.batch) == 0:
+      return
+    self.sink.write(self.batch)
+    self.posted += len(self.batch)
+    if self.ledger is not None:
+      self.ledger.record(self.variable, self.batch.starts, self.batch.ends)
+    self.batch = ReadingStore()
+
+  def close(self):
+    self.sink.close()
+    if self.ledger is not None:
+      self.ledger.close()
+
+def outputFilename(target, options):
+  """Where target's readings go with --output: the name given, or with
+  several meters, that name with the meter's appended."""
+  if len(options.targets) == 1:
+    return options.output
+  (root, extension) = os.path.splitext(options.output)
+  return '%s-%s%s' % (root, target.name, extension)
+
+def makeSink(target, options):
+  """Returns the sink target's readings are sent to: a file with --output,
+  nothing with --debug, Google otherwise. The Google API is only imported
+  (and a connection made) in that last case."""
+  if options.output is not None:
+    return SINK_FORMATS[options.format](outputFilename(target, options))
+  if options.isDebug:
+    return NullSink()
+
+  import google_meter
+  import units
   log = google_meter.Log(1)
-  service = google_meter.Service(token, options.service, log=log)
+  service = google_meter.Service(target.token, options.service, log=log)
   service = google_meter.BatchAdapter(service)
   meter = google_meter.Meter(
-      service, variable, options.uncertainty * units.KILOWATT_HOUR,
+      service, target.variable, options.uncertainty * units.KILOWATT_HOUR,
       options.time_uncertainty, True)
 
-  for i in range(len(readings)/1000 + 1):
-    if len(readings) > 1000:
-      for j in range(1000):
-        reading = readings.pop()
-        start = rfc3339.FromTimestamp(reading.dStart.isoformat())
-        end = rfc3339.FromTimestamp(reading.dEnd.isoformat())
-        meter.PostDur(start,end,reading.energy * units.KILOWATT_HOUR,reading.uncertainty * units.KILOWATT_HOUR)
+  scheduler = UploadScheduler(target.rate / 60, target.burst)
+  sizer = None
+  if options.isAutoBatch:
+    sizer = BatchSizer(target.burst, min(50, target.burst), target.burst, options.flushLatency)
+  return GoogleSink(meter, service, target.burst, scheduler, sizer, units.KILOWATT_HOUR)
+
+def makeUploader(target, options):
+  """Returns an Uploader for target. Only uploads to Google use the
+  ledger. The caller calls uploader.close() when done."""
+  sink = makeSink(target, options)
+  ledger = None
+  if options.ledger is not None and isinstance(sink, GoogleSink):
+    ledger = UploadLedger(options.ledger)
+  return Uploader(sink, target.variable, ledger)
+
+def applyRollup(readings, options, tz=Pacific):
+  """Returns readings rolled up as asked by --rollup, in periods aligned
+  on the local midnights of tz (following DST), keeping a ReadingStore a ReadingStore and
+  a stream a stream."""
+  if options.rollup is None:
+    return readings
+  rolledUp = rollupReadings(readings, int(options.rollup * 3600), tz)
+  if not isinstance(readings, ReadingStore):
+    return rolledUp
+  count = len(readings)
+  readings = ReadingStore()
+  readings.extend(rolledUp)
+  print "Info: Rolled %d durational readings up into %d." % (count, len(readings))
+  return readings
+
+def uploadTarget(target, options):
+  """Reads target's files and uploads them to its meter, over one service
+  connection that is reused for every batch."""
+  counts = dict()
+  if options.isStream:
+    readings = mergeReadings([checkTimeOrder(streamReadings([filename], target.tz), filename)
+                              for filename in target.filenames], options.dedup, counts)
+  else:
+    cache = None
+    if options.cache is not None:
+      cache = ReadingCache(options.cache, int(options.cacheSize * 1048576))
+    readings = loadFiles(target.filenames, options.jobs, cache, options.dedup, target.tz)
+
+  uploader = makeUploader(target, options)
+  try:
+    if options.isStream:
+      print "Info: Streaming durational readings for '%s' to %s as they are parsed." % (target.name, uploader.sink.destination)
+    else:
+      print "Info: Processed %d durational readings for '%s'. Now attempting to upload to %s." % (len(readings), target.name, uploader.sink.destination)
+    readings = applyRollup(uploader.unsent(readings), options, target.tz)
+    posted = uploader.upload(readings)
+  finally:
+    uploader.close()
+  if options.isStream:
+    reportMerge(counts)
+  print "Info: Uploaded %d durational readings to '%s'." % (posted, target.name)
+  if uploader.skipped > 0:
+    print "Info: Skipped %d durational readings for '%s' already in the ledger." % (uploader.skipped, target.name)
+  return posted
+
+class DirectoryWatcher:
+  """Polls a directory for files that are new or changed since last time.
+  A file is only returned once its (mtime, size) held still from one poll
+  to the next, so a download still being written is left for later.
+  Members:
+  directory (str)\tDirectory being watched
+  seen (dict)\tPath -> (mtime, size) when it was last returned
+  polled (dict)\tPath -> (mtime, size) at the last poll"""
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.seen = dict()
+    self.polled = dict()
+
+  def changed(self):
+    """Returns the paths of new or changed files that are stable, oldest
+    first."""
+    changed = list()
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      if not os.path.isfile(path) or name.startswith('.'):
+        continue
+      signature = (stat.st_mtime, stat.st_size)
+      if self.seen.get(path) == signature:
+        continue
+      if self.polled.get(path) == signature:
+        self.seen[path] = signature
+        changed.append((stat.st_mtime, path))
+      else:
+        self.polled[path] = signature
+    changed.sort()
+    return [path for (mtime, path) in changed]
+
+def loadNewDays(filename, after, tz=Pacific):
+  """Reads and converts the days of filename later than the date after
+  (None for all of them). Returns the ReadingStore, in time order, and the
+  new watermark: the latest date converted with none of its readings
+  missing, and no day missing readings before it, or after if there is
+  none. Days past the watermark are read again next time, so a day PG&E
+  has only partly filled in, or a row cut short, is completed once the
+  file is; the readings already sent from them are for the ledger to skip."""
+  readings = ReadingStore()
+  complete = list()
+  partial = None
+  for (times, day) in iterFileDays(filename, tz):
+    if after is not None and day.day <= after:
+      continue
+    counts = {'missing_readings': 0, 'gaps': 0}
+    if convertDays(times, [day], readings, counts) == 0 or counts['missing_readings'] > 0:
+      if partial is None or day.day < partial:
+        partial = day.day
+    else:
+      complete.append(day.day)
+  readings.sortByStart()
+  latest = after
+  for day in complete:
+    if (partial is None or day < partial) and (latest is None or day > latest):
+      latest = day
+  return (readings, latest)
+
+def watchDirectory(target, options):
+  """Uploads files as they show up or change in options.watch, until
+  interrupted. Only days past the watermark of loadNewDays() are read, and
+  the uploader (with its connection and quota) stays up between files. A
+  file that can not be parsed is reported and skipped until it changes
+  again.
+  The watermark is kept in memory only: without --ledger, an in-memory
+  ledger keeps the days read again from being sent twice, but a restart
+  sends every file in options.watch again."""
+  watcher = DirectoryWatcher(options.watch)
+  uploader = makeUploader(target, options)
+  if uploader.ledger is None:
+    uploader.ledger = UploadLedger(':memory:')
+    if isinstance(uploader.sink, GoogleSink):
+      print "Warning: Without --ledger, restarting --watch uploads every file in '%s' again." % options.watch
+  lastDay = None
+  print "Info: Watching '%s' for new files every %d seconds." % (options.watch, options.interval)
+  try:
+    while True:
+      for filename in watcher.changed():
+        try:
+          (readings, lastDay) = loadNewDays(filename, lastDay, target.tz)
+        except Exception, e:
+          sys.stderr.write("Error: Could not parse '%s' (%s); skipping it until it changes.\n" % (filename, e))
+          continue
+        if len(readings) == 0:
+          continue
+        posted = uploader.upload(applyRollup(uploader.unsent(readings), options, target.tz))
+        print "Info: Uploaded %d durational readings from '%s'." % (posted, filename)
+      sleeptime.sleep(options.interval)
+  except KeyboardInterrupt:
+    print "Info: Stopped watching '%s'." % options.watch
+  finally:
+    uploader.close()
+
+def uploadTargets(targets, options):
+  """Uploads to every target, up to options.workers of them at a time.
+  Each target has its own connection and its own UploadScheduler, so the
+  quota of one meter never holds back another. Returns the names of the
+  targets that failed."""
+  if len(targets) == 1:
+    uploadTarget(targets[0], options)
+    return list()
+
+  queue = Queue.Queue()
+  for target in targets:
+    queue.put(target)
+  failed = list()
+
+  def work():
+    while True:
+      try:
+        target = queue.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        uploadTarget(target, options)
+      except Exception, e:
+        sys.stderr.write("Error: Upload to '%s' failed: %s\n" % (target.name, e))
+        failed.append(target.name)
+
+  threads = [threading.Thread(target=work) for i in range(min(options.workers, len(targets)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return failed
+
+# Time-of-use periods, as (name, weekdays only, local start hour, local
+# end hour). Hours not covered belong to TOU_DEFAULT.
+TOU_PERIODS = (('peak', True, 13, 19),
+               ('partpeak', True, 10, 13),
+               ('partpeak', True, 19, 21))
+TOU_DEFAULT = 'offpeak'
+
+class UsageIndex:
+  """Answers usage questions about time-ordered readings (a ReadingStore)
+  in constant time per query, from indexes built once up front:
+    - prefix sums of energy, overall and per time-of-use period;
+    - the index of the first reading of every local day;
+    - a sparse table over the daily maxima, for peaks.
+  Queries are by local date, first to last inclusive. Readings belong to
+  the local day, hour and period their start falls in.
+  Members:
+  readings (ReadingStore)\tThe readings indexed
+  tz (USTimeZone)\tZone local days are in
+  firstDay (datetime.date)\tFirst local day with readings
+  lastDay (datetime.date)\tLast local day with readings
+  periods (list(str))\tTime-of-use period names
+  prefix (dict)\tNone (all) or period name -> array('d') of prefix sums
+  dayFirst (array('l'))\tIndex of the first reading of each day, from firstDay
+  dayPeaks (list(array('l')))\tSparse table of the index of the largest
+  \treading over 2**level days"""
+
+  def __init__(self, readings, tz=Pacific):
+    self.readings = readings
+    self.tz = tz
+    self.periods = list()
+    for (name, weekdays, first, last) in TOU_PERIODS:
+      if name not in self.periods:
+        self.periods.append(name)
+    self.periods.append(TOU_DEFAULT)
+
+    self.prefix = dict()
+    for key in [None] + self.periods:
+      self.prefix[key] = array('d', [0.0])
+    self.dayFirst = array('l')
+    dailyPeaks = array('l')
+    self.firstDay = None
+    self.lastDay = None
+
+    total = 0.0
+    totals = dict([(name, 0.0) for name in self.periods])
+    for (i, (start, end, energy, uncertainty)) in enumerate(readings):
+      local = datetime.fromtimestamp(start, tz)
+      day = local.date()
+      if self.firstDay is None:
+        self.firstDay = day
+        self.lastDay = day - DAY
+      while self.lastDay < day:
+        # Days without readings start (and end) where the next one starts,
+        # and have no peak (-1).
+        self.lastDay += DAY
+        self.dayFirst.append(i)
+        dailyPeaks.append(-1)
+      if dailyPeaks[-1] == -1 or energy > readings.energies[dailyPeaks[-1]]:
+        dailyPeaks[-1] = i
+
+      period = TOU_DEFAULT
+      for (name, weekdays, first, last) in TOU_PERIODS:
+        if first <= local.hour < last and not (weekdays and local.weekday() >= 5):
+          period = name
+          break
+      total += energy
+      totals[period] += energy
+      self.prefix[None].append(total)
+      for name in self.periods:
+        self.prefix[name].append(totals[name])
+    self.dayFirst.append(len(readings))
+
+    self.dayPeaks = [dailyPeaks]
+    width = 1
+    while width * 2 <= len(dailyPeaks):
+      previous = self.dayPeaks[-1]
+      level = array('l')
+      for i in range(len(previous) - width):
+        level.append(self.larger(previous[i], previous[i + width]))
+      self.dayPeaks.append(level)
+      width *= 2
+
+  def larger(self, i, j):
+    """Whichever of readings i and j is larger; -1 stands for no reading."""
+    if i == -1 or (j != -1 and self.readings.energies[j] > self.readings.energies[i]):
+      return j
+    return i
+
+  def days(self, first, last):
+    """Returns the (first, last) day numbers from firstDay, clamped to the
+    days indexed, or None if no indexed day is in the range."""
+    if self.firstDay is None:
+      return None
+    a = max(0, (first - self.firstDay).days)
+    b = min(len(self.dayFirst) - 2, (last - self.firstDay).days)
+    if a > b:
+      return None
+    return (a, b)
+
+  def total(self, first, last, period=None):
+    """kWh used from local date first to last, inclusive; only in the
+    time-of-use period named period, if given."""
+    days = self.days(first, last)
+    if days is None:
+      return 0.0
+    prefix = self.prefix[period]
+    return prefix[self.dayFirst[days[1] + 1]] - prefix[self.dayFirst[days[0]]]
+
+  def touTotals(self, first, last):
+    """Returns [(period, kWh)] from local date first to last, inclusive."""
+    return [(name, self.total(first, last, name)) for name in self.periods]
+
+  def peak(self, first, last):
+    """Returns the largest reading from local date first to last,
+    inclusive, as a (start, end, energy, uncertainty) row, or None."""
+    days = self.days(first, last)
+    if days is None:
+      return None
+    (a, b) = days
+    level = 0
+    while 1 << (level + 1) <= b - a + 1:
+      level += 1
+    table = self.dayPeaks[level]
+    i = self.larger(table[a], table[b - (1 << level) + 1])
+    if i == -1:
+      return None
+    return (self.readings.starts[i], self.readings.ends[i],
+            self.readings.energies[i], self.readings.uncertainties[i])
+
+  def rangeTotal(self, start, end):
+    """kWh used by readings starting from start up to (not including) end,
+    both POSIX timestamps. Takes a binary search, not constant time."""
+    i = bisect.bisect_left(self.readings.starts, start)
+    j = bisect.bisect_left(self.readings.starts, end)
+    return self.prefix[None][max(i, j)] - self.prefix[None][i]
+
+def parseDate(text):
+  """Parses YYYY-MM-DD (or YYYY-MM, as its first day) into a date."""
+  parts = [int(part) for part in text.split('-')]
+  if len(parts) == 2:
+    parts.append(1)
+  if len(parts) != 3:
+    raise ValueError("'%s' is not YYYY-MM-DD or YYYY-MM" % text)
+  return date(*parts)
+
+def lastOfMonth(day):
+  if day.month == 12:
+    return date(day.year, 12, 31)
+  return date(day.year, day.month + 1, 1) - DAY
+
+def runQuery(argv):
+  """The 'query' subcommand: usage totals and peaks of local files."""
+  op = OptionParser('%prog query [options] Filename.csv [File2.csv [...]]\n\n'
+                    'Prints the kWh used per month of the files, unless other periods are asked for.')
+  op.add_option('', '--day', dest='days', metavar='<YYYY-MM-DD>', action='append', help="Report the day; may be repeated", default=[])
+  op.add_option('', '--month', dest='months', metavar='<YYYY-MM>', action='append', help="Report the month; may be repeated", default=[])
+  op.add_option('', '--from', dest='first', metavar='<YYYY-MM-DD>', help="Report from this day...")
+  op.add_option('', '--to', dest='last', metavar='<YYYY-MM-DD>', help="...to this day, inclusive")
+  op.add_option('', '--daily', dest='isDaily', action='store_true', help="Report every day rather than every month", default=False)
+  op.add_option('', '--tou', dest='isTOU', action='store_true', help="Break totals down into time-of-use periods", default=False)
+  op.add_option('', '--timezone', metavar='<zone>', help="US time zone of the files, e.g. Pacific or EST (default: Pacific)", default='Pacific')
+  options, args = op.parse_args(argv)
+  if len(args) < 1:
+    sys.stderr.write('Error: No input file specified.\n')
+    op.exit(2, op.format_help())
+  try:
+    tz = lookupTimeZone(options.timezone)
+  except ValueError, e:
+    sys.stderr.write('Error: Bad --timezone (%s).\n' % e)
+    op.exit(2, op.format_help())
+
+  try:
+    periods = list()
+    for day in options.days:
+      day = parseDate(day)
+      periods.append((day, day))
+    for month in options.months:
+      month = parseDate(month)
+      periods.append((month, lastOfMonth(month)))
+    if options.first is not None or options.last is not None:
+      if options.first is None or options.last is None:
+        raise ValueError('--from and --to go together')
+      periods.append((parseDate(options.first), parseDate(options.last)))
+  except ValueError, e:
+    sys.stderr.write('Error: Bad date (%s).\n' % e)
+    op.exit(2, op.format_help())
+
+  stdout = sys.stdout
+  sys.stdout = sys.stderr # Keep parser chatter out of the report.
+  try:
+    index = UsageIndex(loadFiles(args, tz=tz), tz)
+  except ValueError, e:
+    sys.stdout = stdout
+    sys.stderr.write('Error: %s\n' % e)
+    exit(1)
+  finally:
+    sys.stdout = stdout
+  if index.firstDay is None:
+    sys.stderr.write('Error: No readings in the input files.\n')
+    exit(1)
+
+  if len(periods) == 0:
+    day = index.firstDay
+    while day <= index.lastDay:
+      if options.isDaily:
+        periods.append((day, day))
+        day += DAY
+      else:
+        periods.append((day, min(lastOfMonth(day), index.lastDay)))
+        day = lastOfMonth(day) + DAY
+
+  for (first, last) in periods:
+    if first == last:
+      label = first.isoformat()
     else:
-      for reading in readings:
-        start = rfc3339.FromTimestamp(reading.dStart.isoformat())
-        end = rfc3339.FromTimestamp(reading.dEnd.isoformat())
-        meter.PostDur(start,end,reading.energy * units.KILOWATT_HOUR,reading.uncertainty * units.KILOWATT_HOUR)
-      if not options.isDebug:
-        service.Flush()
-      break
-    if not options.isDebug:
-      service.Flush()
-    print "There remains %d measurements to upload." % len(readings)
-    for k in range(10):
-      print "Sleeping for %d minutes." % (10-k)
-      sleeptime.sleep(60)
+      label = '%s .. %s' % (first.isoformat(), last.isoformat())
+    line = '%s: %.3f kWh' % (label, index.total(first, last))
+    peak = index.peak(first, last)
+    if peak is not None:
+      line += ', peak %.3f kWh at %s' % (peak[2], datetime.fromtimestamp(peak[0], index.tz).strftime('%Y-%m-%d %H:%M %Z'))
+    print line
+    if options.isTOU:
+      print '  ' + ', '.join(['%s %.3f kWh' % touTotal for touTotal in index.touTotals(first, last)])
 
+if __name__ == '__main__':
+  if len(sys.argv) > 1 and sys.argv[1] == 'query':
+    runQuery(sys.argv[2:])
+    exit(0)
 
+  (filenames, options) = parseArguments()
 
+  if options.watch is not None:
+    watchDirectory(options.targets[0], options)
+    failed = list()
+  else:
+    try:
+      failed = uploadTargets(options.targets, options)
+    except ValueError, e:
+      # Unreadable input, e.g. a daily report (see parseHeader).
+      sys.stderr.write('Error: %s\n' % e)
+      exit(1)
+  if STATS.counters.get('missing_readings', 0) > 0:
+    print "Info: %d readings were missing from the input, in %d gaps; they were not uploaded." % (
+        STATS.counters['missing_readings'], STATS.counters['gaps'])
+  if options.isStats:
+    STATS.printTable()
+  if options.statsFile is not None:
+    STATS.write(options.statsFile)
+  if len(failed) > 0:
+    exit(1)
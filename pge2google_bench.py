@@ -0,0 +1,161 @@
+#!/usr/bin/python2.6
+# pge2google_bench.py
+# 	Benchmarks pge2google.py against synthetic PG&E SmartMeter CSV data.
+# 	http://gitorious.org/pge-to-google-powermeter/
+#
+#   Copyright (C) 2010  Andrew Potter
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Generates an hourly-usage CSV file shaped like the ones PG&E hands out
+# (headers, '-' gaps, 'Missing data' rows, Cost rows and both DST
+# transition days), then times each stage of pge2google.py on it:
+# readfile(), parseToReadings() and the upload path. The upload goes to a
+# stub service, so nothing leaves the machine, and the Google API
+# (google_meter.py) is not needed.
+#
+#    python pge2google_bench.py --days 3650
+
+import os
+import sys
+import random
+import resource
+import tempfile
+import time as sleeptime
+from datetime import timedelta, date
+from optparse import OptionParser
+import pge2google
+
+def generateCSV(filename, first, days, seed=0):
+  """Writes days of synthetic hourly usage starting at first to filename."""
+  rand = random.Random(seed)
+  hours = list()
+  for hour in range(24):
+    hours.append('%d:00 %s' % (hour % 12 or 12, hour < 12 and 'AM' or 'PM'))
+
+  with open(filename, 'w') as f:
+    f.write('Title,Hourly Usage\n')
+    f.write('Primary Data Unit,kWh\n')
+    f.write('Account Number,0123456789\n')
+    f.write('Service Address,"1 MAIN ST, ANYTOWN CA"\n')
+    f.write('\n')
+    f.write('kWh,%s\n' % ','.join(hours))
+    for i in range(days):
+      day = first + timedelta(i)
+      readings = ['%.3f' % rand.uniform(0.05, 3.0) for hour in hours]
+      kind = pge2google.Pacific.classifyDay(day)
+      if kind == pge2google.SPRING_DAY:
+        readings[2] = '-'
+      elif kind == pge2google.FALL_DAY:
+        readings[1] = '%.3f' % rand.uniform(0.1, 6.0)
+      if rand.random() < 0.02:
+        # An outage of a few hours.
+        start = rand.randrange(24)
+        for hour in range(start, min(24, start + rand.randrange(1, 6))):
+          readings[hour] = '-'
+      elif rand.random() < 0.002:
+        readings = ['-'] * 24
+      f.write('"%d/%d/%d",%s\n' % (day.month, day.day, day.year, ','.join(readings)))
+      if '-' in readings:
+        f.write('Missing data for %d/%d/%d\n' % (day.month, day.day, day.year))
+    f.write('\n')
+    f.write('Cost,%d/%d/%d,$%.2f\n' % (first.month, first.day, first.year, rand.uniform(50, 200)))
+    f.write('per kWh,%d/%d/%d,$0.12\n' % (first.month, first.day, first.year))
+
+class StubService:
+  """Stands in for google_meter.BatchAdapter; counts flushes."""
+
+  def __init__(self):
+    self.flushes = 0
+
+  def Flush(self):
+    self.flushes += 1
+
+class StubMeter:
+  """Stands in for google_meter.Meter; counts posts."""
+
+  def __init__(self):
+    self.posts = 0
+
+  def PostDur(self, start, end, quantity, uncertainty):
+    self.posts += 1
+
+def peakMemory():
+  """Peak resident memory of this process so far, in MB."""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def timeStage(results, name, rows, size, function, *args):
+  start = sleeptime.time()
+  result = function(*args)
+  elapsed = sleeptime.time() - start
+  results.append((name, elapsed, rows(result), size, peakMemory()))
+  return result
+
+def upload(readings):
+  service = StubService()
+  meter = StubMeter()
+  scheduler = pge2google.UploadScheduler(1e9, 1000, sleep=lambda seconds: None)
+  # Energies go to the stub meter as plain kWh, so units is not imported.
+  sink = pge2google.GoogleSink(meter, service, scheduler=scheduler, kWh=1.0)
+  uploader = pge2google.Uploader(sink, 'benchmark')
+  uploader.upload(readings)
+  return meter.posts
+
+def printResults(results):
+  print '%-16s %10s %12s %12s %10s %14s' % ('stage', 'seconds', 'rows', 'rows/s', 'MB/s', 'peak RSS (MB)')
+  for (name, elapsed, rows, size, peak) in results:
+    elapsed = max(elapsed, 1e-9)
+    if size is None:
+      throughput = '-'
+    else:
+      throughput = '%.2f' % (size / elapsed / 1048576)
+    print '%-16s %10.3f %12d %12.0f %10s %14.1f' % (name, elapsed, rows, rows / elapsed, throughput, peak)
+
+if __name__ == '__main__':
+  op = OptionParser('%prog [options]')
+  op.add_option('-n','--days', metavar='<N>', type='int', help="Days of hourly data to generate (default: 365)", default=365)
+  op.add_option('', '--seed', metavar='<N>', type='int', help="Random seed for the generated data (default: 0)", default=0)
+  op.add_option('-o','--output', metavar='<file>', help="Keep the generated CSV at <file> (default: a temporary file)")
+  options, args = op.parse_args()
+
+  if options.output is None:
+    (fd, filename) = tempfile.mkstemp(suffix='.csv', prefix='pge2google_bench')
+    os.close(fd)
+  else:
+    filename = options.output
+
+  try:
+    generateCSV(filename, date(2009, 1, 1), options.days, options.seed)
+    size = os.path.getsize(filename)
+    print "Info: Generated %d days (%d bytes) in '%s'." % (options.days, size, filename)
+
+    # The parsers print a line for every DST day and empty day; keep the
+    # table readable.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    results = list()
+    try:
+      (times, days) = timeStage(results, 'readfile', lambda result: len(result[1]), size,
+                                pge2google.readfile, filename)
+      readings = timeStage(results, 'parseToReadings', len, None,
+                           pge2google.parseToReadings, times, days)
+      timeStage(results, 'upload', lambda posts: posts, None, upload, readings)
+    finally:
+      sys.stdout.close()
+      sys.stdout = stdout
+    printResults(results)
+  finally:
+    if options.output is None:
+      os.remove(filename)
@@ -0,0 +1,346 @@
+#!/usr/bin/python2.6
+# test_pge2google.py
+# 	Regression tests for pge2google.py.
+# 	http://gitorious.org/pge-to-google-powermeter/
+#
+#   Copyright (C) 2010  Andrew Potter
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Nothing here talks to Google. Run it with:
+#
+#    python test_pge2google.py
+
+import os
+import sys
+import csv
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib2
+import BaseHTTPServer
+from datetime import date
+import pge2google
+
+HOURS = ['%d:00 %s' % (hour % 12 or 12, hour < 12 and 'AM' or 'PM') for hour in range(24)]
+
+# Day rows as PG&E writes them: quoted and unquoted dates, '-' gaps, and a
+# day with no readings at all.
+FIXTURE = '\n'.join([
+  'kWh,' + ','.join(HOURS),
+  '"3/13/2010",' + ','.join(['%.3f' % (0.1 * hour) for hour in range(24)]),
+  '3/14/2010,0.5,0.6,-,' + ','.join(['1.25'] * 21),
+  '"3/15/2010",-,-,-,' + ','.join(['0.75'] * 18) + ',-,-,-',
+  '"3/16/2010",' + ','.join(['-'] * 24),
+  '11/7/2010,' + ','.join(['2.000'] * 23) + ',-',
+])
+
+class Quiet:
+  """Hides what is printed, on stdout and stderr, for the duration of a
+  with block."""
+
+  def __enter__(self):
+    (self.stdout, self.stderr) = (sys.stdout, sys.stderr)
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+
+  def __exit__(self, *exc):
+    sys.stdout.close()
+    (sys.stdout, sys.stderr) = (self.stdout, self.stderr)
+
+class DecodeDayTest(unittest.TestCase):
+  """RowTemplate.decodeDay() must give exactly what parseDay() gives."""
+
+  def setUp(self):
+    self.template = pge2google.RowTemplate(self.rows()[0])
+
+  def rows(self):
+    return list(csv.reader(FIXTURE.splitlines(), delimiter=',', quotechar='"'))
+
+  def assertSameDay(self, row):
+    with Quiet():
+      expected = pge2google.parseDay(list(row))
+      decoded = self.template.decodeDay(list(row))
+    self.assertEqual(decoded.day, expected.day)
+    self.assertEqual(decoded.readings, expected.readings)
+    self.assertEqual(decoded.valid, expected.valid)
+
+  def testFixture(self):
+    for row in self.rows()[1:]:
+      self.assertSameDay(row)
+
+  def testQuotesKeptInDate(self):
+    # Rows not read through csv keep the quotes around the date.
+    for row in self.rows()[1:]:
+      self.assertSameDay(['"%s"' % row[0]] + row[1:])
+
+  def testGapsAndMissingDay(self):
+    with Quiet():
+      days = [self.template.decodeDay(row) for row in self.rows()[1:]]
+    self.assertEqual(days[0].valid, (1 << 24) - 1)
+    self.assertEqual(days[1].valid, ((1 << 24) - 1) & ~(1 << 2))
+    self.assertEqual(days[1].readings[2], 0.0)
+    self.assertEqual(days[3].valid, 0)
+    self.assertEqual(list(days[3].readings), [0.0] * 24)
+
+class FakeClock:
+  """Clock and sleep for UploadScheduler: sleeping only moves the clock,
+  and every sleep is recorded with the scheduler's rate at that moment.
+  Members:
+  now (float)\tCurrent time, in seconds
+  sleeps (list)\t(seconds, rate) of every sleep
+  scheduler (UploadScheduler)\tScheduler whose rate is recorded"""
+
+  def __init__(self):
+    self.now = 1000.0
+    self.sleeps = list()
+    self.scheduler = None
+
+  def time(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.sleeps.append((seconds, self.scheduler.rate))
+    self.now += seconds
+
+class QuotaHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answers 503 (over quota) while the server has failures left to
+  give, then 201. Every request body is recorded."""
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+    self.server.bodies.append(body)
+    if self.server.failures > 0:
+      self.server.failures -= 1
+      self.server.statuses.append(503)
+      self.send_response(503, 'Quota exceeded')
+    else:
+      self.server.statuses.append(201)
+      self.send_response(201, 'Created')
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+class QuotaServer(BaseHTTPServer.HTTPServer):
+  """Local stand-in for the PowerMeter feed, run in a background thread.
+  Members:
+  failures (int)\tRequests still to be refused
+  bodies (list(str))\tBody of every request received
+  statuses (list(int))\tStatus each request was answered with
+  url (str)\tWhere to post"""
+
+  def __init__(self, failures=0):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), QuotaHandler)
+    self.failures = failures
+    self.bodies = list()
+    self.statuses = list()
+    self.url = 'http://127.0.0.1:%d/feed' % self.server_port
+    self.thread = threading.Thread(target=self.serve_forever)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+class StandInService:
+  """Stands in for google_meter.BatchAdapter: Flush() posts the pending
+  entries to url, one per line, and raises if the post is refused. Each
+  Flush() moves clock (a FakeClock, if any) on by the next of latencies."""
+
+  def __init__(self, url, clock=None, latencies=()):
+    self.url = url
+    self.pending = list()
+    self.clock = clock
+    self.latencies = list(latencies)
+
+  def Flush(self):
+    if self.latencies:
+      self.clock.now += self.latencies.pop(0)
+    urllib2.urlopen(urllib2.Request(self.url, ''.join(self.pending))).close()
+    self.pending = list()
+
+class StandInMeter:
+  """Stands in for google_meter.Meter: PostDur() queues an entry on the
+  service."""
+
+  def __init__(self, service):
+    self.service = service
+
+  def PostDur(self, start, end, quantity, uncertainty):
+    self.service.pending.append('%d %d %r %r\n' % (start, end, quantity, uncertainty))
+
+class SchedulerTest(unittest.TestCase):
+  """UploadScheduler against a stand-in service that runs out of quota."""
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.scheduler = pge2google.UploadScheduler(10.0, 100, clock=self.clock.time, sleep=self.clock.sleep)
+    self.clock.scheduler = self.scheduler
+
+  def flush(self, failures):
+    server = QuotaServer(failures)
+    try:
+      service = StandInService(server.url)
+      service.pending.append('reading\n')
+      try:
+        with Quiet():
+          self.scheduler.flush(service)
+      finally:
+        self.requests = len(server.bodies)
+    finally:
+      server.stop()
+
+  def testRecovers(self):
+    self.flush(2)
+    # Each failure halves the rate, and the backoff doubles.
+    self.assertEqual(self.clock.sleeps, [(60.0, 5.0), (120.0, 2.5)])
+    self.assertEqual(self.requests, 3)
+    self.assertEqual(self.scheduler.lastRetries, 2)
+    # Success wins back a quarter of the rate and resets the backoff.
+    self.assertEqual(self.scheduler.rate, 2.5 * 1.25)
+    self.assertEqual(self.scheduler.backoff, pge2google.UploadScheduler.minBackoff)
+
+  def testGivesUp(self):
+    retries = pge2google.UploadScheduler.maxRetries
+    self.assertRaises(urllib2.HTTPError, self.flush, retries + 1)
+    self.assertEqual(self.requests, retries + 1)
+    self.assertEqual([seconds for (seconds, rate) in self.clock.sleeps],
+                     [60.0 * 2 ** i for i in range(retries)])
+
+  def testAcquireWaitsForQuota(self):
+    with Quiet():
+      self.scheduler.acquire(100)
+      self.assertEqual(self.clock.sleeps, [])
+      self.scheduler.acquire(50)
+    self.assertEqual(self.clock.sleeps, [(5.0, 10.0)])
+
+class GoogleSinkTest(unittest.TestCase):
+  """Uploads through GoogleSink to a stand-in service, checking what
+  reaches the wire and how BatchSizer sizes the batches."""
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.readings = pge2google.ReadingStore()
+    for i in range(400):
+      self.readings.add(3600 * i, 3600 * (i + 1), 0.25 * (i % 7))
+    self.expected = ''.join(['%d %d %r %r\n' % row for row in self.readings])
+
+  def upload(self, failures=0, latencies=(), sizer=None):
+    """Uploads self.readings; returns the (status, body) of each post."""
+    scheduler = pge2google.UploadScheduler(1e6, 1000, clock=self.clock.time, sleep=self.clock.sleep)
+    self.clock.scheduler = scheduler
+    server = QuotaServer(failures)
+    try:
+      service = StandInService(server.url, self.clock, latencies)
+      sink = pge2google.GoogleSink(StandInMeter(service), service, 100, scheduler, sizer, 1.0)
+      with Quiet():
+        self.assertEqual(pge2google.Uploader(sink, 'variable').upload(self.readings), 400)
+    finally:
+      server.stop()
+    return zip(server.statuses, server.bodies)
+
+  def testEveryReadingSentOnce(self):
+    posts = self.upload()
+    self.assertEqual([status for (status, body) in posts], [201] * 4)
+    self.assertEqual(''.join([body for (status, body) in posts]), self.expected)
+    self.assertEqual(sum([len(body) for (status, body) in posts]), len(self.expected))
+
+  def testRetriedBatchSentAgain(self):
+    posts = self.upload(failures=1)
+    self.assertEqual(posts[0], (503, posts[1][1]))
+    accepted = [body for (status, body) in posts if status == 201]
+    self.assertEqual(''.join(accepted), self.expected)
+    # The refused post is on the wire too.
+    self.assertEqual(sum([len(body) for (status, body) in posts]),
+                     len(self.expected) + len(posts[0][1]))
+
+  def testSizerFollowsLatency(self):
+    sizer = pge2google.BatchSizer(100, 10, 1000, 10.0)
+    posts = self.upload(latencies=[20.0, 20.0], sizer=sizer)
+    # Slow flushes halve the batch, quick ones grow it by a tenth.
+    self.assertEqual([body.count('\n') for (status, body) in posts],
+                     [100, 50, 25, 27, 29, 31, 34, 37, 40, 27])
+    self.assertEqual(''.join([body for (status, body) in posts]), self.expected)
+
+  def testSizerHalvesAfterRetry(self):
+    sizer = pge2google.BatchSizer(100, 10, 1000, 10.0)
+    posts = self.upload(failures=1, sizer=sizer)
+    self.assertEqual([body.count('\n') for (status, body) in posts][:3], [100, 100, 50])
+
+class RollupLedgerTest(unittest.TestCase):
+  """--rollup with --ledger: what was sent is recorded as intervals, and
+  checked slot by slot before rolling up."""
+
+  # Midnight of 2010-07-01 in Pacific daylight time.
+  midnight = 1277967600
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.ledger = pge2google.UploadLedger(os.path.join(self.directory, 'ledger.db'))
+
+  def tearDown(self):
+    self.ledger.close()
+    shutil.rmtree(self.directory)
+
+  def upload(self, hours):
+    readings = pge2google.ReadingStore()
+    for hour in range(hours):
+      readings.add(self.midnight + 3600 * hour, self.midnight + 3600 * (hour + 1), 1.0, 0.0)
+    uploader = pge2google.Uploader(pge2google.NullSink(), 'variable', self.ledger)
+    rolledUp = pge2google.ReadingStore()
+    rolledUp.extend(pge2google.rollupReadings(uploader.unsent(readings), 86400, pge2google.Pacific))
+    with Quiet():
+      uploader.upload(rolledUp)
+    return list(rolledUp)
+
+  def testSecondHalfOfDaySent(self):
+    self.assertEqual(self.upload(12), [(self.midnight, self.midnight + 12 * 3600, 12.0, 0.0)])
+    self.assertEqual(self.upload(24), [(self.midnight + 12 * 3600, self.midnight + 24 * 3600, 12.0, 0.0)])
+    self.assertEqual(self.upload(24), [])
+
+class LoadNewDaysTest(unittest.TestCase):
+  """--watch reads a day again until none of its readings are missing."""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'usage.csv')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def load(self, rows, after):
+    with open(self.filename, 'w') as f:
+      f.write('\n'.join(['Title,Hourly Usage', 'Primary Data Unit,kWh', '',
+                         'kWh,' + ','.join(HOURS)] + rows) + '\n')
+    with Quiet():
+      return pge2google.loadNewDays(self.filename, after)
+
+  def testPartialDayReadAgain(self):
+    # The 2 AM slot of 3/14/2010 does not exist, so that day is complete.
+    rows = ['3/14/2010,0.5,0.6,-,' + ','.join(['1.25'] * 21),
+            '3/15/2010,' + ','.join(['1.0'] * 12 + ['-'] * 12)]
+    (readings, latest) = self.load(rows, None)
+    self.assertEqual((len(readings), latest), (23 + 12, date(2010, 3, 14)))
+    rows[1] = '3/15/2010,' + ','.join(['1.0'] * 24)
+    (readings, latest) = self.load(rows, latest)
+    self.assertEqual((len(readings), latest), (24, date(2010, 3, 15)))
+    (readings, latest) = self.load(rows, latest)
+    self.assertEqual((len(readings), latest), (0, date(2010, 3, 15)))
+
+if __name__ == '__main__':
+  unittest.main()